@@ -0,0 +1,326 @@
+import argparse, asyncio, logging
+from ccp_protocol import EspFrameDecoder, ESP_PING_FRAME
+from ccp_core import CcpCore
+from ccp_fleet import FLEET_FILE, load_fleet
+from ccp_logging import setup_logging, stop_logging, console, LOG_COMPRESSION, LOG_COMPRESSORS
+from ccp_tracking import seconds_until
+from ccp_flight_recorder import install_flight_dumps, dump_all
+from ccp_capture import CAPTURE_ESP_IN, CAPTURE_ESP_OUT, CAPTURE_ESP_ATTACH, CAPTURE_ESP_DETACH
+from ccp_link_health import ESP_PING_MISS_WARN, tune_esp_socket, MCP_RCVBUF, set_udp_rcvbuf, UdpDropMonitor
+
+# asyncio CCP engine, serves every BladeRunner ESP over TCP and the MCP over UDP from one event loop
+# Same command and status semantics as ccp_host.py, just without the listener threads, queues and locks
+# Usage: python ccp_async.py [fleet.json] [--sync-log] [--quiet-console] [--capture]
+
+# Transport Protocols
+
+class EspServerProtocol(asyncio.Protocol):
+    # One of these per ESP TCP connection, hands whole frames to the CCP
+    def __init__(self, ccp):
+        self.ccp = ccp
+        self.transport = None
+        self.decoder = EspFrameDecoder()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.ccp.esp_attached(self)
+
+    def data_received(self, data):
+        if self.ccp.capture is not None:
+            self.ccp.capture.write(CAPTURE_ESP_IN, data)
+        for frame in self.decoder.feed(data):
+            self.ccp.parse_esp_response(frame)
+
+    def connection_lost(self, exc):
+        self.ccp.esp_lost(self, exc)
+
+class McpDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, ccp):
+        self.ccp = ccp
+
+    def datagram_received(self, data, addr):
+        self.ccp.mcp_datagram_received(data)
+
+    def error_received(self, exc):
+        # Raised from a previous sendto, usually the MCP isn't up yet
+        self.ccp.log.debug(f"MCP is not available, check IP or MCP Health status: {exc}")
+
+# Core Processing
+
+class AsyncCCP(CcpCore):
+    # The asyncio engine's I/O and timers around the shared CcpCore, every callback runs on the one loop
+    def __init__(self, client_id, ccp_port, mcp_server, esp_ping_interval=None, mcp_rcvbuf=None, mcp_silence_timeout=None, capture=False):
+        super().__init__(client_id, "async", esp_ping_interval, mcp_silence_timeout, capture)
+        self.ccp_port = ccp_port
+        self.mcp_server = mcp_server
+
+        self.esp_server = None
+        self.esp_link = None # Live EspServerProtocol, None while the BR is away
+        self.ack_check_handle = None
+        self.esp_ping_handle = None
+
+        self.mcp_transport = None
+        self.mcp_rcvbuf = mcp_rcvbuf or MCP_RCVBUF
+        self.mcp_retry_handle = None
+        self.mcp_silence_handle = None
+        self.mcp_reinit_handle = None
+
+        self.stat_publish_handle = None
+        self.stat_publish_soon = False
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+
+        self.esp_server = await loop.create_server(lambda: EspServerProtocol(self), '0.0.0.0', self.ccp_port, reuse_address=True)
+        self.mcp_transport, _ = await loop.create_datagram_endpoint(lambda: McpDatagramProtocol(self), local_addr=('0.0.0.0', 0))
+        mcp_socket = self.mcp_transport.get_extra_info("socket")
+        self.mcp_rcvbuf = set_udp_rcvbuf(mcp_socket, self.mcp_rcvbuf)
+        self.mcp_drops = UdpDropMonitor(mcp_socket)
+
+        self.log.debug("ESP Socket listening")
+        self.console(f"Server listening for {self.client_id} on port {self.ccp_port}")
+
+    def close(self):
+        self.log_shutdown()
+        for handle in (self.stat_publish_handle, self.ack_check_handle, self.mcp_retry_handle, self.mcp_silence_handle,
+                       self.mcp_reinit_handle, self.esp_ping_handle):
+            if handle is not None:
+                handle.cancel()
+        if self.esp_link is not None:
+            self.esp_link.transport.close()
+        if self.esp_server is not None:
+            self.esp_server.close()
+        if self.mcp_transport is not None:
+            self.mcp_transport.close()
+        if self.capture is not None:
+            self.capture.close()
+
+    # Engine I/O
+
+    def esp_write(self, byte_data):
+        if self.esp_link is None:
+            return False
+        self.esp_link.transport.write(byte_data)
+        return True
+
+    def mcp_write(self, message, payload):
+        # UDP sendto never blocks, any failure comes back through error_received
+        self.mcp_transport.sendto(payload, self.mcp_server)
+
+    def status_changed(self):
+        # Everything changed within this callback goes out as one STAT, once the loop comes back round
+        self.note_status()
+        if self.stat_publish_soon:
+            return
+        if self.stat_publish_handle is not None:
+            self.stat_publish_handle.cancel()
+        self.stat_publish_soon = True
+        self.stat_publish_handle = asyncio.get_running_loop().call_soon(self.publish_status)
+
+    def timers_changed(self):
+        self.schedule_ack_check()
+        self.schedule_mcp_retry()
+        self.schedule_mcp_silence_check()
+        self.schedule_mcp_reinit()
+
+    def schedule_ack_check(self):
+        # One timer for the earliest outstanding ACK deadline
+        if self.ack_check_handle is not None:
+            self.ack_check_handle.cancel()
+            self.ack_check_handle = None
+
+        ack_deadline_ns = self.esp_pending.next_deadline_ns()
+        if ack_deadline_ns is not None:
+            self.ack_check_handle = asyncio.get_running_loop().call_later(seconds_until(ack_deadline_ns), self.check_esp_acks)
+
+    def schedule_mcp_retry(self):
+        # One timer for the earliest outstanding MCP ack deadline
+        if self.mcp_retry_handle is not None:
+            self.mcp_retry_handle.cancel()
+            self.mcp_retry_handle = None
+
+        ack_deadline_ns = self.mcp_inflight.next_deadline_ns()
+        if ack_deadline_ns is not None:
+            self.mcp_retry_handle = asyncio.get_running_loop().call_later(seconds_until(ack_deadline_ns), self.check_mcp_acks)
+
+    def schedule_mcp_silence_check(self):
+        # One timer at the silence deadline, anything heard since just moves it on when it fires
+        if self.mcp_silence_handle is not None:
+            self.mcp_silence_handle.cancel()
+            self.mcp_silence_handle = None
+
+        silence_deadline_ns = self.mcp_watchdog.silence_deadline_ns()
+        if silence_deadline_ns is not None:
+            self.mcp_silence_handle = asyncio.get_running_loop().call_later(seconds_until(silence_deadline_ns), self.check_mcp_silence)
+
+    def schedule_mcp_reinit(self):
+        # While the MCP is lost, one timer for the next CCIN
+        if self.mcp_reinit_handle is not None:
+            self.mcp_reinit_handle.cancel()
+            self.mcp_reinit_handle = None
+
+        if self.mcp_watchdog.lost:
+            self.mcp_reinit_handle = asyncio.get_running_loop().call_later(seconds_until(self.mcp_watchdog.reinit_due_ns), self.check_mcp_reinit)
+
+    # ESP Link
+
+    def esp_attached(self, link):
+        if self.capture is not None:
+            self.capture.write(CAPTURE_ESP_ATTACH)
+        if self.esp_link is not None:
+            # The BR has come back before we noticed it left, the newest connection is the real one
+            self.log.warning("Replacing existing ESP connection")
+            self.esp_link.transport.close()
+
+        self.esp_link = link
+        self.log.debug("ESP Socket attached")
+        self.console("ESP Socket attached")
+
+        try:
+            tune_esp_socket(link.transport.get_extra_info("socket"))
+        except OSError:
+            self.log.exception("Could not tune ESP socket")
+
+        if self.esp_ping is not None:
+            # New link, a ping in flight on the old one is never coming back
+            self.esp_ping.reset()
+            if self.esp_ping_handle is not None:
+                self.esp_ping_handle.cancel()
+            self.ping_esp()
+
+        self.esp_link_attached()
+
+    def esp_lost(self, link, exc):
+        if link is not self.esp_link:
+            return # Already replaced
+
+        if self.capture is not None:
+            self.capture.write(CAPTURE_ESP_DETACH)
+        self.esp_link = None
+        if self.esp_ping_handle is not None:
+            self.esp_ping_handle.cancel()
+            self.esp_ping_handle = None
+        self.log.critical(f"ESP Socket Connection Lost: {exc}")
+        self.console("ESP Socket Connection Lost")
+        self.esp_link_detached()
+
+    def check_esp_acks(self):
+        self.ack_check_handle = None
+        super().check_esp_acks()
+
+    def ping_esp(self):
+        self.esp_ping_handle = None
+        if self.esp_link is None:
+            return
+
+        if self.esp_ping.tick():
+            self.esp_link.transport.write(ESP_PING_FRAME)
+            self.flight.record("esp_out", data=ESP_PING_FRAME)
+            if self.capture is not None:
+                self.capture.write(CAPTURE_ESP_OUT, ESP_PING_FRAME)
+            self.esp_ping.sent()
+        elif self.esp_ping.missed == ESP_PING_MISS_WARN:
+            self.log.warning(f"ESP hasn't answered a ping in {self.esp_ping.missed} intervals")
+            self.console(f"ESP hasn't answered a ping in {self.esp_ping.missed} intervals")
+
+        self.esp_ping_handle = asyncio.get_running_loop().call_later(seconds_until(self.esp_ping.due_ns), self.ping_esp)
+
+    # MCP Link
+
+    def publish_status(self):
+        # Sends a STAT on change (at most once per minimum interval) or on refresh, then sets itself up for the next one
+        self.stat_publish_handle = None
+        self.stat_publish_soon = False
+        if not self.ccin_sent:
+            return
+
+        esp_write_buffer = self.esp_link.transport.get_write_buffer_size() if self.esp_link is not None else None
+        self.flight.record("depths", data=(esp_write_buffer, len(self.esp_pending), len(self.mcp_inflight)))
+
+        super().publish_status()
+
+        stat_due_ns = self.status_publisher.next_due_ns(self.br.snapshot.status)
+        if stat_due_ns is not None:
+            self.stat_publish_handle = asyncio.get_running_loop().call_later(seconds_until(stat_due_ns), self.publish_status)
+
+    def check_mcp_acks(self):
+        self.mcp_retry_handle = None
+        super().check_mcp_acks()
+
+    def check_mcp_silence(self):
+        self.mcp_silence_handle = None
+        if not self.mcp_watchdog.silent():
+            self.schedule_mcp_silence_check()
+            return
+
+        self.mcp_lost()
+        self.check_mcp_reinit()
+
+    def check_mcp_reinit(self):
+        # Keep offering a CCIN (with backoff) til an AKIN says the MCP is back
+        self.mcp_reinit_handle = None
+        if self.mcp_watchdog.reinit_due():
+            self.reinit_mcp_connection()
+        self.timers_changed()
+
+    def mcp_datagram_received(self, data):
+        self.check_mcp_drops()
+        mcp_msg = self.mcp_accept(data)
+        if mcp_msg is not None:
+            self.mcp_watchdog.heard()
+            self.parse_mcp_response(mcp_msg)
+
+# System Initiation
+
+def loop_fault(loop, context):
+    # Anything a callback raised that nothing caught, the loop carries on but we want the lead up to it
+    loop.default_exception_handler(context)
+    dump_all("fault", rate_limited=True)
+
+async def run_fleet(fleet, capture=False):
+    asyncio.get_running_loop().set_exception_handler(loop_fault)
+
+    ccps = []
+    for entry in fleet:
+        ccp = AsyncCCP(entry.client_id, entry.esp_port, entry.mcp_server, entry.esp_ping_interval, entry.mcp_rcvbuf,
+                       entry.mcp_silence_timeout, capture)
+        try:
+            await ccp.start()
+        except OSError:
+            # One BR's port being taken shouldn't stop us serving the rest
+            ccp.log.exception("Could not bring up ESP server")
+            ccp.console(f"Could not bring up ESP server on port {entry.esp_port}, this BR is offline")
+            ccp.close()
+            continue
+        ccps.append(ccp)
+
+    try:
+        await asyncio.Event().wait() # Runs until cancelled (Ctrl+C)
+    finally:
+        for ccp in ccps:
+            ccp.close()
+
+def main_logic():
+    parser = argparse.ArgumentParser(description="asyncio CCP engine")
+    parser.add_argument("fleet_file", nargs="?", default=FLEET_FILE)
+    parser.add_argument("--sync-log", action="store_true", help="write the log file on the event loop instead of through the log queue")
+    parser.add_argument("--quiet-console", action="store_true", help="send terminal output through the log queue as well")
+    parser.add_argument("--log-compression", choices=sorted(LOG_COMPRESSORS), default=LOG_COMPRESSION, help="how rolled log segments are compressed")
+    parser.add_argument("--capture", action="store_true", help="record every BR's traffic to logs/ for ccp_replay.py")
+    args = parser.parse_args()
+    fleet = load_fleet(args.fleet_file)
+
+    setup_logging("async_ccp", queued=not args.sync_log, quiet_console=args.quiet_console, compression=args.log_compression)
+    install_flight_dumps()
+    logging.info('Starting async CCP Operations')
+    console("Starting async CCP Operations")
+
+    try:
+        asyncio.run(run_fleet(fleet, args.capture))
+    except KeyboardInterrupt:
+        logging.info("Async CCP stopped")
+    finally:
+        stop_logging()
+
+if __name__ == '__main__':
+    main_logic()
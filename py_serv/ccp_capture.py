@@ -0,0 +1,114 @@
+import json, os, struct, threading, time
+from datetime import datetime
+from ccp_logging import LOG_DIR
+from ccp_tracking import TimedLock
+
+# Session capture, every byte a BR's CCP takes in or sends out on either link, with a monotonic timestamp, in a compact binary file
+# ccp_replay.py feeds a capture back through the CCP offline, so a field incident becomes a repeatable test
+# File layout: CAPTURE_MAGIC, then records of CAPTURE_RECORD (mono_ns, kind, length) followed by length bytes of payload
+# The first record is always CAPTURE_INFO, a JSON object with the BR and the settings it ran with
+
+CAPTURE_MAGIC = b"CCPCAP1\n"
+CAPTURE_RECORD = struct.Struct("<QBH") # mono_ns, kind, payload length
+CAPTURE_BUFFER = 64 * 1024 # Records are written through a buffer this size, flushed at least every CAPTURE_FLUSH_INTERVAL
+CAPTURE_FLUSH_INTERVAL = 1.0 # Seconds, so a kill or crash loses at most about this much off the end of a capture
+CAPTURE_SUFFIX = ".ccpcap"
+
+CAPTURE_INFO = 0
+CAPTURE_ESP_IN = 1 # Bytes as they came off the ESP socket, before they're split into frames
+CAPTURE_ESP_OUT = 2
+CAPTURE_MCP_IN = 3 # Whole datagrams, before the filter, so other BRs' traffic is in there too
+CAPTURE_MCP_OUT = 4 # As handed to the MCP socket (or the outbox in front of it), retransmits included
+CAPTURE_ESP_ATTACH = 5 # No payload, the BR connected
+CAPTURE_ESP_DETACH = 6 # No payload, the BR's connection went
+
+CAPTURE_KIND_NAMES = {CAPTURE_INFO: "info", CAPTURE_ESP_IN: "esp_in", CAPTURE_ESP_OUT: "esp_out", CAPTURE_MCP_IN: "mcp_in",
+                      CAPTURE_MCP_OUT: "mcp_out", CAPTURE_ESP_ATTACH: "esp_attach", CAPTURE_ESP_DETACH: "esp_detach"}
+CAPTURE_INPUTS = {CAPTURE_ESP_IN, CAPTURE_MCP_IN, CAPTURE_ESP_ATTACH, CAPTURE_ESP_DETACH}
+CAPTURE_OUTPUTS = {CAPTURE_ESP_OUT, CAPTURE_MCP_OUT}
+CAPTURE_FLUSHED = {CAPTURE_INFO, CAPTURE_ESP_ATTACH, CAPTURE_ESP_DETACH} # Go straight to disk, they're rare and mark where a session turned
+
+capture_writers = [] # Every open capture in the process, for the flusher
+capture_writers_lock = threading.Lock()
+capture_flusher = None
+
+def capture_flusher_thread():
+    # One thread for the whole process, so a quiet session still ends up on disk
+    while True:
+        time.sleep(CAPTURE_FLUSH_INTERVAL)
+        with capture_writers_lock:
+            writers = list(capture_writers)
+        for writer in writers:
+            writer.flush()
+
+def capture_path(client_id):
+    date_time = datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
+    return os.path.join(LOG_DIR, f"{client_id}_capture_{date_time}{CAPTURE_SUFFIX}")
+
+class CaptureWriter:
+    # Appends records for one BR, from whichever thread saw the traffic
+    # The timestamp is taken under the lock so records are in time order in the file as well
+    def __init__(self, path, info):
+        if not os.path.exists(os.path.dirname(path) or "."):
+            os.makedirs(os.path.dirname(path))
+
+        self.path = path
+        self.lock = TimedLock("capture")
+        self.capture_file = open(path, "wb", buffering=CAPTURE_BUFFER)
+        self.capture_file.write(CAPTURE_MAGIC)
+        self.records = 0
+        self.write(CAPTURE_INFO, json.dumps(info).encode())
+
+        global capture_flusher
+        with capture_writers_lock:
+            capture_writers.append(self)
+            if capture_flusher is None:
+                capture_flusher = threading.Thread(target=capture_flusher_thread, name="capture-flush", daemon=True)
+                capture_flusher.start()
+
+    def write(self, kind, data=b""):
+        with self.lock:
+            if self.capture_file is None:
+                return # Closed on the way out, a listener that hasn't noticed yet can still get here
+            self.capture_file.write(CAPTURE_RECORD.pack(time.monotonic_ns(), kind, len(data)))
+            self.capture_file.write(data)
+            self.records += 1
+            if kind in CAPTURE_FLUSHED:
+                self.capture_file.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.capture_file is not None:
+                self.capture_file.flush()
+
+    def close(self):
+        with capture_writers_lock:
+            if self in capture_writers:
+                capture_writers.remove(self)
+        with self.lock:
+            if self.capture_file is not None:
+                self.capture_file.close()
+                self.capture_file = None
+
+def read_capture(path):
+    # Returns the CAPTURE_INFO object and every record after it as (mono_ns, kind, data)
+    # A capture cut short by a crash ends part way through a record, that last record is left out
+    with open(path, "rb") as capture_file:
+        contents = capture_file.read()
+
+    if not contents.startswith(CAPTURE_MAGIC):
+        raise ValueError(f"{path} is not a CCP capture")
+
+    records = []
+    offset = len(CAPTURE_MAGIC)
+    while offset + CAPTURE_RECORD.size <= len(contents):
+        mono_ns, kind, length = CAPTURE_RECORD.unpack_from(contents, offset)
+        offset += CAPTURE_RECORD.size
+        if offset + length > len(contents):
+            break
+        records.append((mono_ns, kind, contents[offset:offset + length]))
+        offset += length
+
+    if not records or records[0][1] != CAPTURE_INFO:
+        raise ValueError(f"{path} has no capture info record")
+    return json.loads(records[0][2]), records[1:]
@@ -0,0 +1,426 @@
+import logging, random
+from ccp_protocol import (bladeRunnerCommands, ESP_CMD_NAMES, EspCmdNames, BR_STATUS, ESP_FRAME_TABLE, ESP_FRAME_ACK, ESP_FRAME_ALERT,
+                          ESP_FRAME_UNKNOWN_ACK, ESP_FRAME_PING, BrState, BR_EVENT_ACK_TIMEOUT, BR_EVENT_ESP_LOST,
+                          encode_esp_cmds, mcp_exec_plan, mcp_exec_identity, mcp_exec_needs_akex, McpMsgTemplates, McpMsgFilter)
+from ccp_logging import console_for, EventLog
+from ccp_tracking import NS_PER_MS, PendingAckTable, McpInFlightTable, McpExecDedup, StatusPublisher, McpWatchdog, MCP_SILENCE_TIMEOUT
+from ccp_flight_recorder import FlightRecorder
+from ccp_capture import CaptureWriter, capture_path, CAPTURE_ESP_OUT, CAPTURE_MCP_IN, CAPTURE_MCP_OUT
+from ccp_link_health import EspPingTracker
+
+# One BR's CCP, everything between its ESP and the MCP that doesn't depend on how an engine does its I/O
+# ccp_host.py (threads) and ccp_async.py (asyncio) each subclass it and only supply the I/O:
+#   esp_write(byte_data) puts bytes on the live ESP link, False if there isn't one or the write failed
+#   mcp_write(message, payload) hands a datagram to the MCP without blocking
+#   status_changed() and timers_changed() are told whenever the status or one of the deadlines may have moved
+
+class CcpCore:
+    def __init__(self, client_id, engine, esp_ping_interval=None, mcp_silence_timeout=None, capture=False):
+        self.client_id = client_id
+        self.log = logging.getLogger(client_id)
+        self.console = console_for(f"{client_id}: ").info # Several BRs share one terminal, tag everything with who said it
+        self.flight = FlightRecorder(client_id) # Last few thousand events in memory, dumped when something goes wrong
+        self.event = EventLog(client_id, self.flight) # Structured events, one JSON line each
+        self.recorded_status = None # Last status the flight recorder saw
+        # Every byte in and out on both links for ccp_replay.py, off unless asked for
+        self.capture = CaptureWriter(capture_path(client_id), {"br": client_id, "engine": engine, "esp_ping_interval": esp_ping_interval,
+                                                               "mcp_silence_timeout": mcp_silence_timeout}) if capture else None
+
+        # ESP Communication
+        self.esp_pending = PendingAckTable() # Sent commands still waiting on their ACK, with deadlines
+        self.esp_ping = EspPingTracker(esp_ping_interval) if esp_ping_interval else None # Link health ping, off unless the fleet table turns it on
+
+        # MCP Communication
+        self.mcp_templates = McpMsgTemplates(client_id)
+        self.mcp_filter = McpMsgFilter(client_id)
+        self.mcp_inflight = McpInFlightTable() # STAT/CCIN waiting on their AKST/AKIN, keyed by sequence number
+        self.mcp_exec_seen = McpExecDedup() # Recent EXECs and the AKEX we answered them with
+        self.mcp_watchdog = McpWatchdog(mcp_silence_timeout or MCP_SILENCE_TIMEOUT) # How long since the MCP last said anything
+        self.mcp_drops = None # Datagrams the kernel threw away before we got to them, set once the engine has a socket
+        self.mcp_rcvbuf = None
+
+        # BladeRunner State
+        self.br = BrState() # Status, door and last command, only ever moved on by the transition table
+        self.sequence_number = -1
+        self.ccin_sent = False # The MCP only hears from us once our BR has attached
+        self.status_publisher = StatusPublisher() # Decides when the BR status is worth a STAT
+
+    # Engine I/O
+
+    def esp_write(self, byte_data):
+        raise NotImplementedError
+
+    def mcp_write(self, message, payload):
+        raise NotImplementedError
+
+    def status_changed(self):
+        pass
+
+    def timers_changed(self):
+        pass
+
+    # Unsorted Helpers
+
+    def get_sequence_number(self):
+        # Here, s_ccp is a unique sequence number randomly chosen from the range 1000-30000,
+        # BRXX is the Blade Runner ID, and s_mcp is a unique sequence number randomly chosen from the range 1000-30000,
+        # and might not be the same value as s_ccp.
+
+        if (self.sequence_number == -1):
+            self.sequence_number = random.randint(1000, 30000)
+        else:
+            self.sequence_number = self.sequence_number + 1
+        return self.sequence_number
+
+    def note_status(self):
+        # Status transitions go in the flight recorder, and going to ERR dumps it
+        status = self.br.snapshot.status
+        if status != self.recorded_status:
+            self.flight.record("status", data=(self.recorded_status, status))
+            self.recorded_status = status
+            if status == BR_STATUS[5]:
+                self.flight.dump("err", rate_limited=True)
+
+    def publish_status(self):
+        # Status changes only ever move br on, this sends it on change (at most once per minimum interval) or on refresh
+        if self.status_publisher.due(self.br.snapshot.status):
+            self.send_mcp_stat()
+
+    def log_shutdown(self, **extra):
+        # Figures for the log and the shutdown event, extra is whatever the engine has of its own
+        self.log.info("ESP ACK latency: %s", self.esp_ack_latency())
+        self.log.info("MCP ack latency: %s", self.mcp_ack_latency())
+        if self.mcp_drops is not None:
+            self.check_mcp_drops(force=True)
+        if self.esp_ping is not None:
+            self.log.info("ESP ping RTT: %s", self.esp_ping.summary())
+        self.log.info("MCP outages: %d", self.mcp_watchdog.outages)
+        self.log.info("Invalid BR transitions: %s", self.br.invalid_summary())
+        self.event("shutdown", esp_ack_latency=self.esp_ack_latency(), mcp_ack_latency=self.mcp_ack_latency(),
+                   mcp_drops=self.mcp_drops.drops if self.mcp_drops is not None else None, mcp_outages=self.mcp_watchdog.outages,
+                   invalid_transitions=self.br.invalid_summary(), **extra)
+
+    # ESP Link
+
+    def esp_link_attached(self):
+        self.event("esp_attached")
+        if not self.ccin_sent:
+            self.init_mcp_connection()
+        else:
+            # Back after an outage, nothing the MCP asked for in between was carried out, so the BR starts again from a STOP
+            # and its ACK tells us where the door is
+            self.log.warning("BR is back, stopping it til the MCP asks for something new")
+            self.console("BR is back, stopping it til the MCP asks for something new")
+            self.send_esp_msg((bladeRunnerCommands["STOP"],))
+
+    def esp_link_detached(self):
+        self.event("esp_detached")
+        self.esp_pending.clear() # Nothing on the old link will be ACKed now
+        self.timers_changed()
+        if self.ccin_sent and self.br.snapshot.status != BR_STATUS[5]:
+            # The refresh keeps the MCP told til the BR is back
+            self.br.apply(BR_EVENT_ESP_LOST)
+            self.log.critical("Logging with MCP that our BR has stopped Responding")
+            self.console("Logging with MCP that our BR has stopped Responding")
+            self.status_changed()
+
+    def send_esp_msg(self, esp_cmds, byte_data=None, retransmit=None):
+        # Sends a whole command sequence in a single write and records each command as awaiting its ACK
+        # Returns False if it never went out, nothing is held for later since the BR could be anywhere by then
+        if byte_data is None:
+            byte_data = encode_esp_cmds(esp_cmds)
+
+        if self.esp_write(byte_data):
+            self.flight.record("esp_out", data=byte_data)
+            if self.capture is not None:
+                self.capture.write(CAPTURE_ESP_OUT, byte_data)
+            if retransmit is not None:
+                self.esp_pending.retransmitted(retransmit)
+            else:
+                for esp_cmd in esp_cmds:
+                    self.esp_pending.sent(esp_cmd)
+            self.timers_changed()
+
+            esp_cmd_names = EspCmdNames(esp_cmds)
+            self.log.debug("Sent to ESP: %s", esp_cmd_names)
+            self.console("Sent to ESP: %s", esp_cmd_names)
+            self.event("esp_tx", cmds=esp_cmd_names, retransmit=retransmit is not None)
+            return True
+
+        esp_cmd_names = EspCmdNames(esp_cmds)
+        self.log.warning("ESP not attached, not sent: %s", esp_cmd_names)
+        self.console("ESP not attached, not sent: %s", esp_cmd_names)
+        self.event("esp_tx_dropped", cmds=esp_cmd_names)
+        return False
+
+    def check_esp_acks(self):
+        # Retransmit anything the ESP hasn't ACKed in time, once a command has used up its retries the BR is in ERR
+        for entry in self.esp_pending.expired():
+            if entry.retries < self.esp_pending.max_retries:
+                self.log.warning("No ACK for %s in time, retransmitting (retry %d)", ESP_CMD_NAMES[entry.cmd], entry.retries + 1)
+                self.console("No ACK for %s in time, retransmitting (retry %d)", ESP_CMD_NAMES[entry.cmd], entry.retries + 1)
+                self.send_esp_msg((entry.cmd,), retransmit=entry)
+            else:
+                self.log.critical("BR never ACKed %s after %d retries, ERR", ESP_CMD_NAMES[entry.cmd], entry.retries)
+                self.console("BR never ACKed %s after %d retries, ERR", ESP_CMD_NAMES[entry.cmd], entry.retries)
+                self.br.apply(BR_EVENT_ACK_TIMEOUT)
+                self.event("esp_ack_timeout", cmd=ESP_CMD_NAMES[entry.cmd], retries=entry.retries, status=self.br.snapshot.status)
+                self.status_changed()
+        self.timers_changed()
+
+    def esp_rtt_ms(self):
+        # Live RTT to the ESP, None if pings are off or nothing has come back yet
+        return self.esp_ping.rtt_ms() if self.esp_ping is not None else None
+
+    def esp_ack_latency(self):
+        # Send to ACK latency per command type, in ms
+        return {ESP_CMD_NAMES[cmd]: summary for cmd, summary in self.esp_pending.latency_summary().items()}
+
+    def parse_esp_response(self, frame):
+        self.flight.record("esp_in", data=frame)
+
+        # One index tells us what the frame is and everything it can lead to
+        kind, cmd, br_event = ESP_FRAME_TABLE[frame]
+
+        if kind == ESP_FRAME_ACK:
+            # Matched by command, so a lost or doubled ACK can't throw off the ones after it
+            ack_latency_ns = self.esp_pending.acked(cmd)
+
+            if ack_latency_ns is None:
+                self.log.info("Received ACK from BR for %s with nothing pending (duplicate or unsolicited)", ESP_CMD_NAMES[cmd])
+                self.console("Received ACK from BR for %s with nothing pending", ESP_CMD_NAMES[cmd])
+            else:
+                self.log.info("Received ACK from BR for %s after %.2f ms", ESP_CMD_NAMES[cmd], ack_latency_ns / NS_PER_MS)
+                self.console("Received ACK from BR for %s after %.2f ms", ESP_CMD_NAMES[cmd], ack_latency_ns / NS_PER_MS)
+
+            transition = self.br.apply(br_event)
+            self.log.log(transition.level, transition.message)
+            self.console(transition.message)
+            self.event("esp_ack", cmd=ESP_CMD_NAMES[cmd], latency_ms=None if ack_latency_ns is None else ack_latency_ns / NS_PER_MS,
+                       status=transition.status, door_open=transition.door_open, invalid=transition.invalid)
+            self.status_changed()
+
+        elif kind == ESP_FRAME_ALERT:
+            # Now we have an ALERT from the ESP
+            self.log.debug("Received Alert from BR: %02x", cmd)
+
+            if br_event is not None:
+                previous_status = self.br.snapshot.status
+                transition = self.br.apply(br_event)
+                self.log.log(transition.level, transition.message)
+                self.console(transition.message)
+                if transition.status != previous_status:
+                    self.status_changed()
+            self.event("esp_alert", alert=cmd, status=self.br.snapshot.status)
+
+        elif kind == ESP_FRAME_PING:
+            if self.esp_ping is not None:
+                rtt_ns = self.esp_ping.replied()
+                if rtt_ns is None:
+                    self.log.debug("Received ping reply from BR with no ping in flight")
+                else:
+                    self.event("esp_ping", rtt_ms=rtt_ns / NS_PER_MS)
+
+        elif kind == ESP_FRAME_UNKNOWN_ACK:
+            self.log.debug("Received ACK from BR for unknown command: %02x", cmd)
+            self.console("Received ACK from BR for unknown command: %02x", cmd)
+
+        else:
+            self.log.warning("Received non-valid action back from BR: %02x", frame >> 8)
+            self.console("Received non-valid action back from BR: %02x", frame >> 8)
+
+    # Master Control Program Interfacing
+
+    def send_mcp_msg(self, message, status=None, track=True):
+        # Takes the next sequence number and returns it, the payload comes pre-encoded from our templates
+        # track=False leaves it out of the in flight table, for messages something else already paces the resends of
+        sequence_number = self.get_sequence_number()
+        payload = self.mcp_templates.encode(message, sequence_number, status)
+        self.send_mcp_payload(message, payload)
+        if track:
+            self.mcp_inflight.sent(message, sequence_number, payload)
+            self.timers_changed()
+
+        self.log.debug("Queued message for MCP: %s %d %s", message, sequence_number, status)
+        self.event("mcp_tx", sequence_number, message=message, status=status)
+        return sequence_number
+
+    def send_mcp_payload(self, message, payload):
+        # Never blocks, whatever the engine sends through deals with the MCP being down
+        self.mcp_write(message, payload)
+        if self.capture is not None:
+            self.capture.write(CAPTURE_MCP_OUT, payload)
+
+    def send_mcp_akex(self):
+        sequence_number = self.send_mcp_msg("AKEX")
+        self.console("Sent AKEX to MCP, seq %d", sequence_number)
+        return sequence_number
+
+    def send_mcp_stat(self):
+        status = self.br.snapshot.status # Read once, the STAT and what we record as published can't disagree
+        sequence_number = self.send_mcp_msg("STAT", status)
+        self.status_publisher.published(status)
+        self.console("Sent STAT %s to MCP, seq %d", status, sequence_number)
+
+    def send_noip(self):
+        self.send_mcp_msg("NOIP")
+        self.log.warning("Received NOIP command/message, sent reply")
+        self.console("Received NOIP command/message, sent reply")
+
+    def check_mcp_acks(self):
+        # Retransmit anything the MCP hasn't acked in time with backoff, same sequence number so its ack still matches
+        for entry in self.mcp_inflight.expired():
+            if entry.retries < self.mcp_inflight.max_retries:
+                self.log.warning("No ack for %s %d, retransmitting (retry %d)", entry.message, entry.sequence_number, entry.retries + 1)
+                self.send_mcp_payload(entry.message, entry.payload)
+                self.mcp_inflight.retransmitted(entry)
+                self.event("mcp_retransmit", entry.sequence_number, message=entry.message, retry=entry.retries)
+            else:
+                self.log.critical("MCP never acked %s %d after %d retries", entry.message, entry.sequence_number, entry.retries)
+                self.console("MCP never acked %s %d after %d retries", entry.message, entry.sequence_number, entry.retries)
+                self.event("mcp_ack_timeout", entry.sequence_number, message=entry.message, retries=entry.retries)
+        self.timers_changed()
+
+    def mcp_acked(self, mcp_msg):
+        entry, ack_latency_ns = self.mcp_inflight.acked(mcp_msg["message"], mcp_msg.get("sequence_number"))
+
+        if entry is None:
+            self.log.debug("Received %s with nothing in flight (duplicate or late)", mcp_msg["message"])
+        else:
+            self.log.debug("Received %s for %s %d after %.2f ms", mcp_msg["message"], entry.message, entry.sequence_number, ack_latency_ns / NS_PER_MS)
+            self.event("mcp_ack", entry.sequence_number, ack=mcp_msg["message"], latency_ms=ack_latency_ns / NS_PER_MS)
+
+    def mcp_ack_latency(self):
+        # Send to ack latency per message type, in ms
+        return self.mcp_inflight.latency_summary()
+
+    def replay_duplicate_exec(self, exec_identity):
+        # A repeat of an EXEC we've already carried out gets the same AKEX again and never reaches the ESP
+        if exec_identity is None:
+            return False
+
+        duplicate, akex_sequence_number = self.mcp_exec_seen.lookup(exec_identity)
+        if not duplicate:
+            return False
+
+        self.log.warning("Duplicate EXEC %s seq %d from MCP, not re-running it", exec_identity[1], exec_identity[0])
+        self.console("Duplicate EXEC %s seq %d from MCP, not re-running it", exec_identity[1], exec_identity[0])
+        self.event("mcp_exec_duplicate", exec_identity[0], action=exec_identity[1], akex_seq=akex_sequence_number)
+        if akex_sequence_number is not None:
+            self.send_mcp_payload("AKEX", self.mcp_templates.encode("AKEX", akex_sequence_number))
+        return True
+
+    def init_mcp_connection(self):
+        # Initialisation message for MCP
+        sequence_number = self.send_mcp_msg("CCIN")
+        self.log.debug("Initialisation message sent to MCP, seq %d", sequence_number)
+        self.console("Initialisation message sent to MCP, seq %d", sequence_number)
+        # STATs start from here, the first unprompted one goes on the first change or refresh
+        self.status_publisher.published(self.br.snapshot.status)
+        self.ccin_sent = True
+        self.mcp_watchdog.arm() # The MCP has til the silence timeout to answer
+        self.status_changed()
+        self.timers_changed()
+
+    def reinit_mcp_connection(self):
+        # MCP has gone quiet, keep offering a CCIN (with backoff) til an AKIN says it's back
+        # The watchdog's backoff is the only thing pacing these, the in flight retries would undo it
+        sequence_number = self.send_mcp_msg("CCIN", track=False)
+        self.log.warning("Re-registering with MCP, seq %d (attempt %d)", sequence_number, self.mcp_watchdog.reinit_attempts)
+        self.console("Re-registering with MCP, seq %d (attempt %d)", sequence_number, self.mcp_watchdog.reinit_attempts)
+
+    def mcp_registered(self):
+        # Returns True if this AKIN ended an outage
+        if not self.mcp_watchdog.registered():
+            return False
+
+        # Whatever the MCP knew about us went with it, it gets our status straight away
+        self.status_publisher.reset()
+        self.log.info("MCP is back after %d CCINs", self.mcp_watchdog.reinit_attempts)
+        self.event("mcp_registered", ccins=self.mcp_watchdog.reinit_attempts)
+        self.console("MCP is back, re-registered")
+        self.status_changed()
+        self.timers_changed()
+        return True
+
+    def mcp_lost(self):
+        # The watchdog says the MCP has gone quiet, the BR stops til it's back and the reinit schedule takes over
+        self.log.critical("No valid message from MCP in %.1fs, stopping BR and re-registering", self.mcp_watchdog.quiet_for())
+        self.console("MCP has gone quiet, stopping BR and re-registering")
+        self.event("mcp_lost", quiet_s=self.mcp_watchdog.quiet_for())
+        self.send_esp_msg((bladeRunnerCommands["STOP"],))
+        self.mcp_inflight.forget("CCIN") # Re-registering is down to the watchdog now
+        self.timers_changed()
+
+    def mcp_accept(self, data):
+        # Raw datagram to a message for us, None for anything else, logged either way
+        if self.capture is not None:
+            self.capture.write(CAPTURE_MCP_IN, data)
+
+        # Check it is actually for us before going to the trouble of parsing the JSON
+        mcp_msg, reject_reason = self.mcp_filter.decode(data)
+        if mcp_msg is None:
+            if reject_reason is not None:
+                self.log.error("%s: %r", reject_reason, data)
+                self.console(reject_reason)
+            return None # Otherwise another BR's traffic
+
+        self.log.info("Received from MCP: %s", mcp_msg)
+        self.console("Received from MCP: %s", mcp_msg)
+        self.event("mcp_rx", mcp_msg.get("sequence_number"), message=mcp_msg["message"], action=mcp_msg.get("action"))
+        return mcp_msg
+
+    def parse_mcp_response(self, mcp_msg):
+        message = mcp_msg["message"]
+
+        if "STRQ" in message:
+            self.send_mcp_stat()
+
+        elif "EXEC" in message:
+            exec_identity = mcp_exec_identity(mcp_msg)
+            if self.replay_duplicate_exec(exec_identity):
+                return
+
+            action = mcp_msg.get("action")
+            exec_plan = mcp_exec_plan(action, self.br.snapshot.door_open)
+            if exec_plan is None:
+                self.send_noip()
+                return
+
+            if not mcp_exec_needs_akex(action):
+                self.log.critical("MCP Enforced Disconnect")
+                self.console("MCP Enforced Disconnect")
+
+            if not self.send_esp_msg(*exec_plan):
+                # Never reached the BR, so no AKEX and nothing remembered, a repeat of this EXEC gets another go
+                self.send_mcp_msg("NOIP")
+                self.log.warning("EXEC %s not carried out, BR is not attached, sent NOIP", action)
+                self.console("EXEC %s not carried out, BR is not attached, sent NOIP", action)
+                return
+
+            akex_sequence_number = None
+            if mcp_exec_needs_akex(action):
+                akex_sequence_number = self.send_mcp_akex()
+
+            if exec_identity is not None:
+                self.mcp_exec_seen.remember(exec_identity, akex_sequence_number)
+
+        elif "AKST" in message:
+            self.mcp_acked(mcp_msg)
+            self.log.debug("Received AKST from our last STAT")
+            self.console("Received AKST from our last STAT")
+
+        elif "AKIN" in message:
+            self.mcp_acked(mcp_msg)
+            self.mcp_registered()
+            self.log.debug("Received AKIN, Awaiting MCP Commands")
+            self.console("Received AKIN, Awaiting MCP Commands")
+
+        else:
+            self.send_noip()
+
+    def check_mcp_drops(self, force=False):
+        new_drops = self.mcp_drops.check(force=force)
+        if new_drops:
+            self.log.warning("Kernel dropped %d MCP datagrams (%d total), receive buffer is %s bytes", new_drops, self.mcp_drops.drops, self.mcp_rcvbuf)
+            self.console("Kernel dropped %d MCP datagrams", new_drops)
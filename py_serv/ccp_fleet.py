@@ -0,0 +1,39 @@
+import json, os
+from collections import namedtuple
+
+# Fleet table, one entry per BladeRunner this CCP host is responsible for
+# fleet.json is a list of {"client_id": "BR28", "esp_port": 3028, "mcp_server": ["10.20.30.1", 2000]}
+# "esp_ping_interval" (seconds) is optional, it turns on the link health ping for BRs whose firmware answers it
+# "mcp_rcvbuf" (bytes) is optional, it overrides the kernel receive buffer asked for on the BR's MCP socket
+# "mcp_silence_timeout" (seconds) is optional, how long the MCP can go quiet before the BR is stopped and we re-register
+
+FLEET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fleet.json")
+
+FleetEntry = namedtuple("FleetEntry", ["client_id", "esp_port", "mcp_server", "esp_ping_interval", "mcp_rcvbuf", "mcp_silence_timeout"],
+                        defaults=(None, None, None))
+
+def load_fleet(fleet_file=FLEET_FILE):
+    with open(fleet_file) as f:
+        raw_fleet = json.load(f)
+
+    fleet = []
+    for raw_entry in raw_fleet:
+        esp_ping_interval = raw_entry.get("esp_ping_interval")
+        mcp_rcvbuf = raw_entry.get("mcp_rcvbuf")
+        mcp_silence_timeout = raw_entry.get("mcp_silence_timeout")
+        entry = FleetEntry(str(raw_entry["client_id"]), int(raw_entry["esp_port"]),
+                           (str(raw_entry["mcp_server"][0]), int(raw_entry["mcp_server"][1])),
+                           float(esp_ping_interval) if esp_ping_interval is not None else None,
+                           int(mcp_rcvbuf) if mcp_rcvbuf is not None else None,
+                           float(mcp_silence_timeout) if mcp_silence_timeout is not None else None)
+        fleet.append(entry)
+
+    # Two BRs on one port or id would silently fight over the same ESP or MCP traffic
+    client_ids = [entry.client_id for entry in fleet]
+    esp_ports = [entry.esp_port for entry in fleet]
+    if len(set(client_ids)) != len(client_ids):
+        raise ValueError(f"Duplicate client_id in fleet table {fleet_file}")
+    if len(set(esp_ports)) != len(esp_ports):
+        raise ValueError(f"Duplicate esp_port in fleet table {fleet_file}")
+
+    return fleet
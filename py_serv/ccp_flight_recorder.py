@@ -0,0 +1,104 @@
+import itertools, json, os, signal, sys, threading, time
+from datetime import datetime
+from operator import itemgetter
+from ccp_logging import LOG_DIR
+from ccp_tracking import NS_PER_S
+
+# Flight recorder, the last few thousand things each BR did, kept in memory whatever the log level
+# Dumped to logs/ as JSONL when the BR goes to ERR, when something faults, on SIGUSR1 or on an exception nothing caught
+# Recording is one tuple into a preallocated slot, the slow part (sorting and writing) only happens on a dump
+
+FLIGHT_RECORDER_SIZE = 4096 # Events kept per BR, a power of two so the index wraps with a mask
+FLIGHT_DUMP_MIN_INTERVAL = 5.0 # Seconds between dumps that a flapping ERR or a repeating fault can trigger
+
+flight_recorders = [] # Every recorder in the process, so a signal or crash can dump the lot
+
+class FlightRecorder:
+    def __init__(self, client_id, size=FLIGHT_RECORDER_SIZE, min_dump_interval=FLIGHT_DUMP_MIN_INTERVAL):
+        if size <= 0 or size & (size - 1):
+            raise ValueError(f"Flight recorder size must be a power of two, got {size}")
+
+        self.client_id = client_id
+        self.mask = size - 1
+        self.slots = [None] * size # (mono_ns, event, sequence_number, data), overwritten oldest first once it wraps
+        self.counter = itertools.count() # next() on this is atomic, so every thread can record without a lock
+        self.min_dump_interval_ns = int(min_dump_interval * NS_PER_S)
+        self.last_dump_ns = None
+        self.dumps = 0
+        flight_recorders.append(self)
+
+    def record(self, event, sequence_number=None, data=None, now_ns=None):
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        self.slots[next(self.counter) & self.mask] = (now_ns, event, sequence_number, data)
+
+    def snapshot(self):
+        # Oldest first, sorted rather than read from the write position since other threads may be recording as we copy
+        return sorted((slot for slot in self.slots if slot is not None), key=itemgetter(0))
+
+    def dump(self, reason, wait=False, rate_limited=False):
+        # Returns the file the dump goes to, None if a recent dump means this one was skipped
+        now_ns = time.monotonic_ns()
+        if rate_limited and self.last_dump_ns is not None and now_ns - self.last_dump_ns < self.min_dump_interval_ns:
+            return None
+        self.last_dump_ns = now_ns
+        self.dumps += 1
+
+        records = self.snapshot()
+        date_time = datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
+        dump_path = os.path.join(LOG_DIR, f"{self.client_id}_flight_{reason}_{date_time}_{self.dumps}.jsonl")
+        if wait:
+            write_flight_dump(dump_path, self.client_id, reason, records)
+        else:
+            # Off the caller's thread, a dump on ERR shouldn't hold up the core
+            threading.Thread(target=write_flight_dump, args=(dump_path, self.client_id, reason, records),
+                             name=f"{self.client_id}-flight-dump", daemon=True).start()
+        return dump_path
+
+def flight_dump_value(value):
+    # Raw frames go out as hex, anything else JSON can't take goes through str()
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return str(value)
+
+def write_flight_dump(dump_path, client_id, reason, records):
+    if not os.path.exists(LOG_DIR):
+        os.makedirs(LOG_DIR)
+
+    with open(dump_path, "w") as dump_file:
+        dump_file.write(json.dumps({"br": client_id, "reason": reason, "events": len(records)}) + "\n")
+        for now_ns, event, sequence_number, data in records:
+            entry = {"mono_ns": now_ns, "event": event, "seq": sequence_number}
+            if isinstance(data, dict):
+                entry.update(data)
+            elif data is not None:
+                entry["data"] = data
+            dump_file.write(json.dumps(entry, separators=(",", ":"), default=flight_dump_value) + "\n")
+
+def dump_all(reason, wait=False, rate_limited=False):
+    for recorder in flight_recorders:
+        recorder.dump(reason, wait, rate_limited)
+
+def stop_on_signal(signum, frame):
+    raise KeyboardInterrupt
+
+def install_flight_dumps():
+    # SIGUSR1 dumps every BR's recorder (no SIGUSR1 on Windows), an exception nothing caught dumps them before it goes any further
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dump_all("signal"))
+    # SIGTERM (kill, systemd) shuts down the same way as Ctrl+C, so captures, logs and the shutdown figures all get written
+    signal.signal(signal.SIGTERM, stop_on_signal)
+
+    previous_excepthook = sys.excepthook
+    previous_thread_excepthook = threading.excepthook
+
+    def flight_excepthook(exc_type, exc_value, exc_traceback):
+        dump_all("crash", wait=True)
+        previous_excepthook(exc_type, exc_value, exc_traceback)
+
+    def flight_thread_excepthook(args):
+        dump_all("crash", wait=True)
+        previous_thread_excepthook(args)
+
+    sys.excepthook = flight_excepthook
+    threading.excepthook = flight_thread_excepthook
@@ -0,0 +1,615 @@
+import argparse, socket, select, time, logging, threading, queue, random
+from collections import deque
+from ccp_protocol import EspFrameDecoder, ESP_PING_FRAME
+from ccp_core import CcpCore
+from ccp_fleet import FLEET_FILE, load_fleet
+from ccp_logging import setup_logging, stop_logging, console, console_for, LOG_COMPRESSION, LOG_COMPRESSORS
+from ccp_tracking import NS_PER_S, seconds_until, TimedLock
+from ccp_flight_recorder import install_flight_dumps
+from ccp_capture import CAPTURE_ESP_IN, CAPTURE_ESP_OUT, CAPTURE_ESP_ATTACH, CAPTURE_ESP_DETACH
+from ccp_link_health import ESP_PING_MISS_WARN, tune_esp_socket, MCP_RCVBUF, set_udp_rcvbuf, UdpDropMonitor
+
+# Multi-BladeRunner CCP host
+# One process serves every BladeRunner in the fleet table, each BR gets its own BladeRunnerCCP with isolated state
+# and its own threads, so a fault in one BR can't stall the others
+# Usage: python ccp_host.py [fleet.json] [--sync-log] [--quiet-console] [--capture]
+
+BUFFER_SIZE = 1024
+FAULT_BACKOFF = 0.5 # Pause after an unexpected exception in a BR thread so a persistent fault can't spin a core
+ESP_SOCKET_TIMEOUT = 15.0 # Blocking timeout on the ESP client socket, only the listener's recv waits on it
+# Longest the core will spend writing to the ESP before it gives up on the link, the core is what sends the STOP when the MCP
+# goes quiet, so that STOP goes out at most mcp_silence_timeout + ESP_WRITE_TIMEOUT after the MCP was last heard from
+ESP_WRITE_TIMEOUT = 1.0
+ESP_ATTACH_POLL = 1.0 # How often the ESP listener rechecks for shutdown while no BR is attached
+MCP_OUTBOX_MAX = 64 # Messages queued for the MCP before the oldest start getting dropped
+MCP_SEND_BACKOFF = 0.05 # First pause after a failed MCP send, doubled per failure in a row
+MCP_SEND_BACKOFF_CAP = 2.0
+MCP_RECV_BATCH = 64 # Most datagrams drained per wakeup before the core gets a look in
+CORE_STOP_TIMEOUT = 2.0 # How long shutdown waits on the core to finish what it's doing before reading its figures
+
+# Core inbox, (kind, payload) messages, the only way the other threads hand the core anything
+# The core owns the BR's state outright, ACK tables, status, watchdog and all, and is the only thread that writes to the ESP
+CORE_ESP_FRAMES = 0 # Frames off the ESP as action << 8 | cmd, straight from the decoder
+CORE_MCP_MSGS = 1 # Decoded MCP messages that got through the filter
+CORE_ESP_ATTACHED = 2
+CORE_ESP_DETACHED = 3
+CORE_STOP = 4
+
+class EspConnectionManager:
+    # Owns the one listening socket for a BR for the life of the host, accepting reconnects in the background
+    # The live client socket is swapped under a lock, so nobody ever rebinds the port or blocks in accept() but the accept thread
+    # The attach and detach callbacks run under it too, so whoever they tell hears of connections in the order they were swapped
+    def __init__(self, client_id, ccp_port, on_attach, on_detach):
+        self.client_id = client_id
+        self.ccp_port = ccp_port
+        self.log = logging.getLogger(client_id)
+        self.console = console_for(f"{client_id}: ").info
+        self.on_attach = on_attach
+        self.on_detach = on_detach
+
+        self.server_address = ('0.0.0.0', ccp_port)  # Listen on all available interfaces from CCP computer
+        self.server_socket = None
+        self.client_socket = None # Live ESP connection, None while the BR is away
+        self.swap_lock = TimedLock("esp_swap") # Never held across anything that touches a socket
+        self.attached = threading.Event()
+        self.closed = False
+
+    def listen(self):
+        # Bind once, any OSError here means the port is unusable and is left to the caller
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(self.server_address)
+        server_ip = socket.gethostbyname(socket.gethostname())
+
+        # Start listening for incoming connections (max 1 connection in the queue)
+        self.server_socket.listen(1)
+        self.log.debug("ESP Socket listening")
+        self.console(f"Server listening for {self.client_id} on {server_ip}:{self.ccp_port}")
+
+        accept_thread = threading.Thread(target=self.accept_thread, args=(), name=f"{self.client_id}-accept")
+        accept_thread.daemon = True
+        accept_thread.start()
+
+    def accept_thread(self):
+        while not self.closed:
+            try:
+                # Only this thread ever blocks waiting on the BR
+                client_socket, client_address = self.server_socket.accept()
+            except OSError:
+                if self.closed:
+                    break
+                self.log.exception("ESP accept failed")
+                time.sleep(FAULT_BACKOFF)
+                continue
+
+            client_socket.settimeout(ESP_SOCKET_TIMEOUT)
+            try:
+                tune_esp_socket(client_socket)
+            except OSError:
+                self.log.exception("Could not tune ESP socket, falling back to the socket timeout for health")
+
+            with self.swap_lock:
+                old_socket, self.client_socket = self.client_socket, client_socket
+                self.on_attach()
+                self.attached.set()
+
+            if old_socket is not None:
+                # The BR has come back before we noticed it left, the newest connection is the real one
+                # Shutting it down wakes the listener off the stale socket, it closes it once it lets go
+                self.log.warning("Replacing existing ESP connection")
+                self.shutdown_socket(old_socket)
+
+            self.log.debug(f"ESP Socket attached from {client_address[0]}")
+            self.console("ESP Socket attached")
+
+    def current(self):
+        return self.client_socket
+
+    def wait_for_client(self, timeout):
+        # Live socket, or None if the BR still isn't attached after timeout
+        if self.attached.wait(timeout):
+            return self.client_socket
+        return None
+
+    def send(self, client_socket, data):
+        # sendall, but bounded by ESP_WRITE_TIMEOUT rather than the socket timeout, a BR that can't take a few bytes in that
+        # long is as good as gone, the TimeoutError is left to the caller to drop the link
+        deadline_ns = time.monotonic_ns() + int(ESP_WRITE_TIMEOUT * NS_PER_S)
+        data = memoryview(data)
+        while data:
+            if not select.select([], [client_socket], [], seconds_until(deadline_ns))[1]:
+                raise TimeoutError(f"ESP write stalled for {ESP_WRITE_TIMEOUT}s")
+            data = data[client_socket.send(data):]
+
+    def drop(self, client_socket):
+        # Called by whoever saw client_socket fail, a no-op if it has already been swapped out
+        with self.swap_lock:
+            if self.client_socket is not client_socket:
+                return
+            self.client_socket = None
+            self.attached.clear()
+            self.on_detach()
+
+        self.shutdown_socket(client_socket)
+
+    def shutdown_socket(self, client_socket):
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass # Already gone from the other end
+
+    def close(self):
+        self.closed = True
+        with self.swap_lock:
+            client_socket, self.client_socket = self.client_socket, None
+            self.attached.set() # Let the listener see we're closing
+        # Close the connection with the client
+        if client_socket is not None:
+            self.shutdown_socket(client_socket)
+            client_socket.close()
+        # Close the server socket
+        if self.server_socket is not None:
+            self.server_socket.close()
+
+class McpOutbox:
+    # Everything bound for the MCP is queued here and sent by its own thread, so the core never waits on the MCP
+    # A queued STAT is overwritten in place by a newer one, the MCP only cares about the latest status
+    def __init__(self, client_id, mcp_socket, mcp_server, max_size=MCP_OUTBOX_MAX):
+        self.client_id = client_id
+        self.log = logging.getLogger(client_id)
+        self.mcp_socket = mcp_socket
+        self.mcp_server = mcp_server
+        self.max_size = max_size
+
+        self.queued = deque() # [message, payload] slots, oldest first
+        self.queued_stat = None # Slot of the STAT still waiting to go, if any
+        self.lock = TimedLock("mcp_outbox") # Only held to move slots in and out, sendto happens outside it
+        self.ready = threading.Condition(self.lock)
+        self.closed = threading.Event()
+
+        self.sent = 0
+        self.dropped = 0
+        self.overwritten = 0
+        self.send_failures = 0
+
+    def start(self):
+        sender_thread = threading.Thread(target=self.sender_thread, args=(), name=f"{self.client_id}-mcp-out")
+        sender_thread.daemon = True
+        sender_thread.start()
+
+    def put(self, message, payload):
+        with self.ready:
+            if message == "STAT" and self.queued_stat is not None:
+                self.queued_stat[1] = payload
+                self.overwritten += 1
+                return
+
+            if len(self.queued) >= self.max_size:
+                # MCP has been gone a while, the oldest messages are the least use to it now
+                dropped = self.queued.popleft()
+                if dropped is self.queued_stat:
+                    self.queued_stat = None
+                self.dropped += 1
+
+            slot = [message, payload]
+            self.queued.append(slot)
+            if message == "STAT":
+                self.queued_stat = slot
+            self.ready.notify()
+
+    def sender_thread(self):
+        failures = 0
+        while not self.closed.is_set():
+            with self.ready:
+                while not self.queued and not self.closed.is_set():
+                    self.ready.wait()
+                if self.closed.is_set():
+                    break
+                # Peek only, the slot stays queued til it's actually out
+                slot = self.queued[0]
+                payload = slot[1]
+
+            try:
+                self.mcp_socket.sendto(payload, self.mcp_server)
+            except OSError:
+                failures += 1
+                self.send_failures += 1
+                self.log.debug("MCP is not available, check IP or MCP Health status")
+                # Jittered so a fleet of BRs don't all hammer a recovering MCP in step
+                self.closed.wait(min(MCP_SEND_BACKOFF * (2 ** (failures - 1)), MCP_SEND_BACKOFF_CAP) * random.uniform(0.5, 1.5))
+                continue
+
+            failures = 0
+            self.sent += 1
+            with self.ready:
+                # Leave it if it was dropped meanwhile, or overwritten by a newer STAT that still needs to go
+                if self.queued and self.queued[0] is slot and slot[1] is payload:
+                    self.queued.popleft()
+                    if slot is self.queued_stat:
+                        self.queued_stat = None
+
+    def stats(self):
+        return {"queued": len(self.queued), "sent": self.sent, "dropped": self.dropped,
+                "overwritten": self.overwritten, "send_failures": self.send_failures}
+
+    def close(self):
+        self.closed.set()
+        with self.ready:
+            self.ready.notify_all()
+
+class BladeRunnerCCP(CcpCore):
+    # The threaded engine's I/O around the shared CcpCore, the core thread is the only one that touches CcpCore's state
+    def __init__(self, client_id, ccp_port, mcp_server, esp_ping_interval=None, mcp_rcvbuf=None, mcp_silence_timeout=None, capture=False):
+        super().__init__(client_id, "host", esp_ping_interval, mcp_silence_timeout, capture)
+        self.ccp_port = ccp_port
+
+        # Thread Safety Variable
+        self.restart_exit = False # Only to be set to True when we need to either RESTART or exit the system
+
+        # ESP Socket Server
+        self.esp_link = EspConnectionManager(client_id, ccp_port, self.esp_attached, self.esp_detached)
+        self.esp_ping_socket = None # Link the ping tracker's state belongs to
+        self.esp_decoder = EspFrameDecoder() # The ESP listener's own, nothing else reads the ESP
+
+        # MCP UDP Server
+        self.mcp_server = mcp_server
+        self.mcp_client_socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.mcp_client_socket.bind(('0.0.0.0', 0)) # Bound up front so the listener has a port before anything has gone out
+        self.mcp_rcvbuf = set_udp_rcvbuf(self.mcp_client_socket, mcp_rcvbuf or MCP_RCVBUF)
+        self.mcp_drops = UdpDropMonitor(self.mcp_client_socket) # Datagrams the kernel threw away before we got to them
+        self.mcp_outbox = McpOutbox(client_id, self.mcp_client_socket, mcp_server)
+
+        # Core Processing, everything the listeners and the accept thread pick up comes in through here, the core blocks on it
+        self.core_inbox = queue.SimpleQueue()
+        self.core_stopped = threading.Event()
+        self.br_connected = False # Used to flag for when our BR is attached and listening
+
+    # ESP Socket Control
+
+    def esp_attached(self):
+        # Runs on the accept thread, the core takes it from here
+        if self.capture is not None:
+            self.capture.write(CAPTURE_ESP_ATTACH)
+        self.core_inbox.put((CORE_ESP_ATTACHED, None))
+
+    def esp_detached(self):
+        # Runs on whichever thread saw the link go, the core included
+        if self.capture is not None:
+            self.capture.write(CAPTURE_ESP_DETACH)
+        self.core_inbox.put((CORE_ESP_DETACHED, None))
+
+    def esp_write(self, byte_data):
+        # Only the core writes to the ESP, so nothing else can be part way through a write on this socket
+        esp_client_socket = self.esp_link.current()
+        if esp_client_socket is None:
+            return False
+        try:
+            self.esp_link.send(esp_client_socket, byte_data)
+            return True
+        except TimeoutError:
+            self.log.critical("ESP32 hasn't taken a write in %ss, dropping the connection", ESP_WRITE_TIMEOUT)
+            self.console("ESP32 hasn't taken a write in %ss, dropping the connection", ESP_WRITE_TIMEOUT)
+            self.esp_link.drop(esp_client_socket)
+            return False
+        except (OSError, ValueError):
+            # ValueError is select() on a socket the listener has already closed after dropping it
+            self.log.critical("ESP32 Connection Lost during transmission")
+            self.console("ESP32 Connection Lost during transmission")
+            self.esp_link.drop(esp_client_socket)
+            return False
+
+    def ping_esp(self):
+        # Only the core writes to the ESP, so pings go out from here between commands
+        esp_client_socket = self.esp_link.current()
+        if esp_client_socket is None:
+            return
+        if esp_client_socket is not self.esp_ping_socket:
+            # New link, a ping in flight on the old one is never coming back
+            self.esp_ping.reset()
+            self.esp_ping_socket = esp_client_socket
+
+        if not self.esp_ping.tick():
+            if self.esp_ping.missed == ESP_PING_MISS_WARN:
+                self.log.warning(f"ESP hasn't answered a ping in {self.esp_ping.missed} intervals")
+                self.console(f"ESP hasn't answered a ping in {self.esp_ping.missed} intervals")
+            return
+
+        try:
+            self.esp_link.send(esp_client_socket, ESP_PING_FRAME)
+            self.esp_ping.sent()
+            self.flight.record("esp_out", data=ESP_PING_FRAME)
+            if self.capture is not None:
+                self.capture.write(CAPTURE_ESP_OUT, ESP_PING_FRAME)
+        except (OSError, ValueError):
+            self.log.critical("ESP32 Connection Lost during ping")
+            self.console("ESP32 Connection Lost during ping")
+            self.esp_link.drop(esp_client_socket)
+
+    def esp_listener_thread(self):
+        reading_socket = None
+        while not self.restart_exit:
+            esp_client_socket = self.esp_link.wait_for_client(ESP_ATTACH_POLL)
+            if esp_client_socket is None:
+                continue
+
+            if esp_client_socket is not reading_socket:
+                # Anything half received belongs to the connection that's gone
+                self.esp_decoder.reset()
+                reading_socket = esp_client_socket
+
+            try:
+                # Whatever the ESP has sent, a closed socket comes back as a reset
+                self.esp_received(self.esp_decoder.recv(esp_client_socket))
+            except TimeoutError as e:
+                if e.errno is not None:
+                    # The kernel gave up on the ESP (keepalive or user timeout), the link is dead
+                    self.log.critical("ESP Socket Connection Timed Out")
+                    self.console("ESP Socket Connection Timed Out")
+                    self.esp_link.drop(esp_client_socket)
+                    esp_client_socket.close()
+                    continue
+                # it isn't always a guarantee that emptiness is confirmed by the queue, check again before we think its hit the fan
+                self.log.warning("ESP Socket Timeout")
+                self.console("ESP Socket Timeout")
+                continue
+            except OSError:
+                if self.restart_exit:
+                    # Forcibly Exit
+                    self.log.critical("ESP Socket Terminated")
+                    self.console("ESP Socket Terminated")
+                    break
+                # We have lost the ESP (or it was swapped for a newer connection), the accept thread is already waiting on it
+                self.log.critical("ESP Socket Connection Reset")
+                self.console("ESP Socket Connection Reset")
+                self.esp_link.drop(esp_client_socket)
+                esp_client_socket.close()
+            except Exception:
+                # Anything else is a bug, keep this BR's listener alive rather than losing the link for good
+                self.log.exception("Unexpected fault in ESP listener")
+                self.flight.dump("fault", rate_limited=True)
+                time.sleep(FAULT_BACKOFF)
+            # No sleep here, recv blocks until the ESP has something for us
+
+    def esp_received(self, data):
+        # Pulls every whole frame out of data and hands them to the core
+        if self.capture is not None:
+            self.capture.write(CAPTURE_ESP_IN, data)
+
+        frames = self.esp_decoder.feed(data)
+        if frames:
+            self.core_inbox.put((CORE_ESP_FRAMES, frames))
+
+    # Master Control Program Interfacing
+
+    def mcp_write(self, message, payload):
+        # Never blocks, the outbox's sender thread deals with the MCP being down
+        self.mcp_outbox.put(message, payload)
+
+    def mcp_listener_thread(self):
+        while not self.restart_exit:
+            if self.ccin_sent:
+                batch = []
+
+                try:
+                    # Block for the first datagram, then take everything else already waiting without blocking
+                    batch.append(self.mcp_client_socket.recvfrom(BUFFER_SIZE)[0])
+                    while len(batch) < MCP_RECV_BATCH and select.select([self.mcp_client_socket], [], [], 0)[0]:
+                        batch.append(self.mcp_client_socket.recvfrom(BUFFER_SIZE)[0])
+                except ConnectionResetError:
+                    # Windows reports an earlier sendto hitting a closed port here, the watchdog decides whether the MCP is really gone
+                    self.log.warning("MCP port unreachable")
+
+                except OSError:
+                    # Forcibly Exit
+                    self.log.critical("MCP UDP Socket Terminated")
+                    self.console("MCP UDP Socket Terminated")
+
+                except Exception:
+                    self.log.exception("Unexpected fault in MCP listener")
+                    self.flight.dump("fault", rate_limited=True)
+                    time.sleep(FAULT_BACKOFF)
+
+                if batch:
+                    self.mcp_received(batch)
+                    self.check_mcp_drops()
+            else:
+                time.sleep(0.05) # Nothing to listen for until CCIN has gone out, recvfrom blocks once it has
+
+    def mcp_received(self, batch):
+        accepted = [mcp_msg for mcp_msg in map(self.mcp_accept, batch) if mcp_msg is not None]
+        if accepted:
+            # One message for the whole batch, the core takes it in one go
+            self.core_inbox.put((CORE_MCP_MSGS, accepted))
+
+    # Core Processing
+
+    def core_processing(self):
+        message = None
+        while not self.restart_exit:
+            self.flight.record("depths", data=(self.core_inbox.qsize(), len(self.mcp_outbox.queued), len(self.esp_pending), len(self.mcp_inflight)))
+
+            try:
+                wait_timeout = self.core_pass(message)
+            except Exception:
+                # A bad message or bug only costs this BR the one event, never the whole host
+                self.log.exception("Unexpected fault in core processing")
+                self.flight.dump("fault", rate_limited=True)
+                wait_timeout = FAULT_BACKOFF
+
+            # Never sleep past the next thing the core has scheduled
+            deadline_ns = self.next_core_deadline_ns()
+            if deadline_ns is not None:
+                until_deadline = seconds_until(deadline_ns)
+                wait_timeout = until_deadline if wait_timeout is None else min(wait_timeout, until_deadline)
+
+            try:
+                # Blocks with no CPU use until another thread hands us something, or the next deadline is due
+                message = self.core_inbox.get(timeout=wait_timeout)
+            except queue.Empty:
+                message = None
+
+    def core_message(self, kind, payload):
+        if kind == CORE_ESP_FRAMES:
+            for frame in payload:
+                self.parse_esp_response(frame)
+
+        elif kind == CORE_MCP_MSGS:
+            self.mcp_watchdog.heard()
+            for mcp_msg in payload:
+                self.parse_mcp_response(mcp_msg)
+
+        elif kind == CORE_ESP_ATTACHED:
+            self.br_connected = True
+            self.esp_link_attached()
+
+        elif kind == CORE_ESP_DETACHED:
+            self.br_connected = False
+            self.esp_link_detached()
+
+    def core_pass(self, message=None):
+        # Takes message and everything else already in the inbox, then whatever is due, returns the longest it can sleep (None til woken)
+        if message is not None:
+            self.core_message(*message)
+        while True:
+            try:
+                message = self.core_inbox.get_nowait()
+            except queue.Empty:
+                break
+            self.core_message(*message)
+
+        if self.ccin_sent:
+            # The MCP is served whether or not the BR is attached, an EXEC while it is away is refused with a NOIP, not held
+            self.check_mcp_acks()
+            if self.mcp_watchdog.silent():
+                self.mcp_lost()
+            if self.mcp_watchdog.reinit_due():
+                self.reinit_mcp_connection()
+
+            if self.br_connected:
+                # Normal operation!
+                self.check_esp_acks()
+                if self.esp_ping is not None:
+                    self.ping_esp()
+            # Otherwise the accept thread is already waiting on our Bladerunner connection, the refresh keeps the MCP told til then
+
+            # However many changes that pass made, the MCP gets one STAT with where we ended up
+            self.note_status()
+            self.publish_status()
+
+        else:
+            # Nothing to do til the BR attaches and CCIN goes out
+            self.log.debug("Waiting on BR to attach before initialising with MCP")
+        return None
+
+    def next_core_deadline_ns(self):
+        # Earliest of the next ACK deadline on either link, the MCP going silent, the next CCIN while it's away, the next STAT and the next ping
+        next_deadline_ns = None
+        for deadline_ns in (self.esp_pending.next_deadline_ns(), self.mcp_inflight.next_deadline_ns(), self.mcp_watchdog.silence_deadline_ns(),
+                            self.mcp_watchdog.reinit_due_ns if self.mcp_watchdog.lost else None,
+                            self.status_publisher.next_due_ns(self.br.snapshot.status) if self.ccin_sent else None,
+                            self.esp_ping.due_ns if self.esp_ping is not None and self.br_connected and self.ccin_sent else None):
+            if deadline_ns is not None and (next_deadline_ns is None or deadline_ns < next_deadline_ns):
+                next_deadline_ns = deadline_ns
+        return next_deadline_ns
+
+    # BR Lifecycle
+
+    def run(self):
+        try:
+            try:
+                self.esp_link.listen()
+            except OSError:
+                self.log.exception("Could not bring up ESP socket")
+                self.console(f"Could not bring up ESP socket on port {self.ccp_port}, this BR is offline")
+                return
+
+            br_listener = threading.Thread(target=self.esp_listener_thread, args=(), name=f"{self.client_id}-esp")
+            br_listener.daemon = True
+
+            mcp_thread = threading.Thread(target=self.mcp_listener_thread, args=(), name=f"{self.client_id}-mcp")
+            mcp_thread.daemon = True
+
+            br_listener.start()
+            mcp_thread.start()
+            self.mcp_outbox.start()
+
+            self.core_processing()
+        finally:
+            self.core_stopped.set()
+
+    def lock_summary(self):
+        # Every lock this BR still takes, none of them guard BR state (that's the core's alone) or are held over socket I/O
+        locks = [self.esp_link.swap_lock, self.mcp_outbox.lock]
+        if self.capture is not None:
+            locks.append(self.capture.lock)
+        return {lock.name: lock.summary() for lock in locks}
+
+    def shutdown(self):
+        # The core is stopped before its figures are read, they're its alone til then
+        self.restart_exit = True
+        self.core_inbox.put((CORE_STOP, None))
+        if not self.core_stopped.wait(CORE_STOP_TIMEOUT):
+            self.log.warning(f"Core still busy after {CORE_STOP_TIMEOUT}s, shutting down around it")
+
+        self.log.info(f"MCP outbox: {self.mcp_outbox.stats()}")
+        self.log.info(f"Lock contention: {self.lock_summary()}")
+        self.log_shutdown(locks=self.lock_summary())
+        self.esp_link.close()
+        self.mcp_outbox.close()
+        self.mcp_client_socket.close()
+        if self.capture is not None:
+            self.capture.close()
+
+# System Initiation
+
+def run_host(fleet, capture=False):
+    ccps = []
+    for entry in fleet:
+        ccp = BladeRunnerCCP(entry.client_id, entry.esp_port, entry.mcp_server, entry.esp_ping_interval, entry.mcp_rcvbuf,
+                             entry.mcp_silence_timeout, capture)
+        # Each BR waits on its own ESP in its own thread, so one missing BR doesn't hold up the rest of the fleet
+        br_thread = threading.Thread(target=ccp.run, args=(), name=f"{entry.client_id}-core")
+        br_thread.daemon = True
+        br_thread.start()
+        ccps.append((ccp, br_thread))
+
+    logging.info(f"Serving fleet: {', '.join(entry.client_id for entry in fleet)}")
+    console(f"Serving fleet: {', '.join(entry.client_id for entry in fleet)}")
+
+    try:
+        for ccp, br_thread in ccps:
+            while br_thread.is_alive():
+                br_thread.join(1.0) # Short joins so Ctrl+C still gets through
+    except KeyboardInterrupt:
+        logging.info("CCP host stopped")
+    finally:
+        for ccp, br_thread in ccps:
+            ccp.shutdown()
+
+def serve_fleet(fleet, capture=False, sync_log=False, quiet_console=False, log_compression=LOG_COMPRESSION):
+    # Whole process entry point, ccp_host.py and the single BR launchers all come in here so they all get the log file,
+    # console, event log and flight dumps
+    setup_logging("byte_ccp", queued=not sync_log, quiet_console=quiet_console, compression=log_compression)
+    install_flight_dumps()
+    logging.info('Starting CCP Operations')
+    console("Starting CCP Operations")
+
+    try:
+        run_host(fleet, capture)
+    finally:
+        stop_logging()
+
+def main_logic():
+    parser = argparse.ArgumentParser(description="Multi-BladeRunner CCP host")
+    parser.add_argument("fleet_file", nargs="?", default=FLEET_FILE)
+    parser.add_argument("--sync-log", action="store_true", help="write the log file on the calling thread instead of through the log queue")
+    parser.add_argument("--quiet-console", action="store_true", help="send terminal output through the log queue as well")
+    parser.add_argument("--log-compression", choices=sorted(LOG_COMPRESSORS), default=LOG_COMPRESSION, help="how rolled log segments are compressed")
+    parser.add_argument("--capture", action="store_true", help="record every BR's traffic to logs/ for ccp_replay.py")
+    args = parser.parse_args()
+
+    serve_fleet(load_fleet(args.fleet_file), args.capture, sync_log=args.sync_log, quiet_console=args.quiet_console,
+                log_compression=args.log_compression)
+
+if __name__ == '__main__':
+    main_logic()
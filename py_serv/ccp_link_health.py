@@ -0,0 +1,144 @@
+import os, socket, time
+from ccp_tracking import NS_PER_MS, NS_PER_S, LatencyStats
+
+# ESP link health, shared by every CCP engine
+# The kernel does the dead peer detection (keepalive plus a user timeout on unACKed data), the optional ping
+# keeps data moving on an idle link so that timeout always has something to trip on, and gives us a live RTT
+
+# TCP tuning for the ESP socket
+ESP_KEEPIDLE = 1 # Seconds of silence before the first keepalive probe
+ESP_KEEPINTVL = 1 # Seconds between unanswered probes
+ESP_KEEPCNT = 3 # Unanswered probes before the kernel drops the link
+ESP_USER_TIMEOUT_MS = 750 # Longest sent data (pings included) can go un-ACKed by the ESP's TCP stack before we call it dead
+
+# MCP UDP socket
+MCP_RCVBUF = 256 * 1024 # Bytes of kernel receive buffer asked for, enough to ride out a burst while the listener catches up
+MCP_DROP_CHECK_INTERVAL = 1.0 # Seconds between reads of the kernel's drop counter
+PROC_NET_UDP = ("/proc/net/udp", "/proc/net/udp6")
+
+# Application level ping
+ESP_PING_MISS_WARN = 3 # Ping intervals without a reply before we warn, the firmware loop stalls on door moves so this alone never drops the link
+
+def tune_esp_socket(sock):
+    # Commands are single bytes that need to go now, not when Nagle thinks the segment is full
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    # Not every platform has every knob, use what's there
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, ESP_KEEPIDLE)
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, ESP_KEEPINTVL)
+    if hasattr(socket, "TCP_KEEPCNT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, ESP_KEEPCNT)
+    if hasattr(socket, "TCP_USER_TIMEOUT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, ESP_USER_TIMEOUT_MS)
+
+def set_udp_rcvbuf(sock, rcvbuf):
+    # Returns what the kernel actually gave us, Linux doubles the ask and caps it at net.core.rmem_max
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    return sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+def udp_socket_drops(sock):
+    # Datagrams the kernel has thrown away on this socket because its receive buffer was full
+    # None where there's no /proc/net/udp to ask (anything but Linux)
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+    except (OSError, ValueError):
+        return None
+
+    for path in PROC_NET_UDP:
+        try:
+            proc_file = open(path)
+        except OSError:
+            continue
+        with proc_file:
+            next(proc_file, None) # Header
+            for line in proc_file:
+                fields = line.split()
+                if len(fields) >= 13 and fields[9] == inode:
+                    return int(fields[-1])
+    return None
+
+class UdpDropMonitor:
+    # Checks the drop counter at most once per interval and hands back how many are new
+    def __init__(self, sock, interval=MCP_DROP_CHECK_INTERVAL):
+        self.sock = sock
+        self.interval_ns = int(interval * NS_PER_S)
+        self.check_due_ns = 0
+        self.baseline = None
+        self.drops = 0
+
+    def check(self, now_ns=None, force=False):
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        if now_ns < self.check_due_ns and not force:
+            return 0
+        self.check_due_ns = now_ns + self.interval_ns
+
+        drops = udp_socket_drops(self.sock)
+        if drops is None:
+            return 0
+        if self.baseline is None:
+            self.baseline = drops # Socket may have been around before we started watching it
+        new_drops = drops - self.baseline - self.drops
+        self.drops += new_drops
+        return new_drops
+
+class EspPingTracker:
+    # Only ever one ping in flight, the ping frame carries no id so that's the only way a late reply can't be misread
+    def __init__(self, interval):
+        self.interval_ns = int(interval * NS_PER_S)
+        self.sent_ns = None # Send time of the ping in flight, None if nothing is waiting on a reply
+        self.due_ns = 0
+        self.missed = 0 # Intervals the ping in flight has gone unanswered
+        self.srtt_ns = None # Smoothed RTT, same weighting TCP uses
+        self.stats = LatencyStats()
+
+    def reset(self):
+        # New link, whatever was in flight went with the old one
+        self.sent_ns = None
+        self.due_ns = 0
+        self.missed = 0
+
+    def tick(self, now_ns=None):
+        # True if a ping should go out now, call sent() once it has
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        if now_ns < self.due_ns:
+            return False
+
+        self.due_ns = now_ns + self.interval_ns
+        if self.sent_ns is not None:
+            self.missed += 1
+            return False
+        return True
+
+    def sent(self, now_ns=None):
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        self.sent_ns = now_ns
+
+    def replied(self, now_ns=None):
+        # Returns the RTT in ns, None if no ping was in flight
+        if self.sent_ns is None:
+            return None
+
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        rtt_ns = now_ns - self.sent_ns
+        self.sent_ns = None
+        self.missed = 0
+
+        self.stats.record(rtt_ns)
+        self.srtt_ns = rtt_ns if self.srtt_ns is None else (7 * self.srtt_ns + rtt_ns) // 8
+        return rtt_ns
+
+    def rtt_ms(self):
+        # Live RTT figure, None until the first reply
+        return None if self.srtt_ns is None else self.srtt_ns / NS_PER_MS
+
+    def summary(self):
+        summary = self.stats.summary()
+        summary["srtt_ms"] = self.rtt_ms()
+        return summary
@@ -0,0 +1,175 @@
+import gzip, json, logging, logging.handlers, lzma, os, queue, shutil, sys, threading, time
+from collections import deque
+from datetime import datetime
+
+# Logging shared by every CCP engine
+# In queued mode a log call on the command path only builds a record and drops it on a queue, the formatting and the
+# file write happen on the listener's thread. With a quiet console the terminal lines take the same route instead of
+# going straight to stdout
+# Log calls on the hot path use %-style args rather than f-strings so nothing is formatted until the listener gets to it,
+# which also means anything passed as an arg mustn't be changed after the call
+# Alongside the text log every BR writes structured events, one JSON object per line, for the analysis the text can't do
+# Both files rotate by size and the rolled segments are compressed on a background thread
+
+LOG_DIR = "logs"
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+CONSOLE_LOGGER = "console" # Everything meant for the terminal, in place of print()
+CONSOLE_FORMAT = '%(console_prefix)s%(message)s'
+EVENT_LOGGER = "events"
+LOG_MAX_BYTES = 20 * 1024 * 1024 # Size a log file is rolled at
+LOG_BACKUPS = 10 # Compressed segments kept per file, the oldest are deleted past this
+LOG_COMPRESSION = "gzip"
+LOG_COMPRESSORS = {"gzip": (".gz", gzip.open), "xz": (".xz", lzma.open)}
+
+console_log = logging.getLogger(CONSOLE_LOGGER)
+console_log.propagate = False # Terminal lines already have a paired log line, they don't need to be in the file twice
+event_log = logging.getLogger(EVENT_LOGGER)
+event_log.propagate = False
+log_listener = None
+log_files = [] # Rotating handlers to close (and let finish compressing) on the way out
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock prepare() formats the message on the caller's thread, which is the work we're trying to move off it
+    # Records never leave the process, so the listener can format them exactly as they were logged
+    def prepare(self, record):
+        return record
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    # Rolls the file at max_bytes and compresses the rolled segment on its own thread, so the writer never waits on gzip
+    # Segments are numbered in the order they were written and never renamed after, a slow compression can't race a rollover
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUPS, compression=LOG_COMPRESSION):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count)
+        self.compressed_suffix, self.compressed_open = LOG_COMPRESSORS[compression]
+        self.segment = 0
+        self.segments = deque() # Finished compressed segments, oldest first
+        self.compress_q = queue.SimpleQueue()
+        self.compressor = threading.Thread(target=self.compressor_thread, name=f"{os.path.basename(filename)}-compress", daemon=True)
+        self.compressor.start()
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+        self.segment += 1
+        segment_name = f"{self.baseFilename}.{self.segment}"
+        os.rename(self.baseFilename, segment_name)
+        self.compress_q.put(segment_name)
+        self.stream = self._open()
+
+    def compressor_thread(self):
+        while True:
+            segment_name = self.compress_q.get()
+            if segment_name is None:
+                return
+
+            compressed_name = segment_name + self.compressed_suffix
+            try:
+                # Written under a temporary name so a half finished segment is never mistaken for a whole one
+                with open(segment_name, "rb") as segment, self.compressed_open(compressed_name + ".part", "wb") as compressed:
+                    shutil.copyfileobj(segment, compressed)
+                os.replace(compressed_name + ".part", compressed_name)
+                os.remove(segment_name)
+
+                self.segments.append(compressed_name)
+                while len(self.segments) > self.backupCount:
+                    os.remove(self.segments.popleft())
+            except OSError as e:
+                # Can't log it, that would come straight back through this handler
+                sys.stderr.write(f"Could not compress log segment {segment_name}: {e}\n")
+
+    def close(self):
+        # Lets any segment already handed over finish compressing
+        self.compress_q.put(None)
+        self.compressor.join()
+        super().close()
+
+class EventFormatter(logging.Formatter):
+    # One JSON object per line, fields in the same order every time so the file also reads sensibly by eye
+    def format(self, record):
+        mono_ns, client_id, sequence_number, fields = record.event_fields
+        event = {"mono_ns": mono_ns, "time": record.created, "br": client_id, "event": record.msg, "seq": sequence_number}
+        event.update(fields)
+        return json.dumps(event, separators=(",", ":"), default=str)
+
+class EventLog:
+    # Structured events for one BR: event_log("esp_ack", cmd="STOP", latency_ms=0.4)
+    # Field values go through str() if JSON can't take them, so lazy log args like EspCmdNames work here too
+    # Every event also goes to the BR's flight recorder if it has one, whether or not the event log is on
+    __slots__ = ("client_id", "recorder")
+
+    def __init__(self, client_id, recorder=None):
+        self.client_id = client_id
+        self.recorder = recorder
+
+    def __call__(self, event, sequence_number=None, **fields):
+        now_ns = time.monotonic_ns()
+        if self.recorder is not None:
+            self.recorder.record(event, sequence_number, fields, now_ns)
+        if event_log.isEnabledFor(logging.INFO):
+            event_log.info(event, extra={"event_fields": (now_ns, self.client_id, sequence_number, fields)})
+
+def is_console_record(record):
+    return record.name == CONSOLE_LOGGER
+
+def is_event_record(record):
+    return record.name == EVENT_LOGGER
+
+def is_log_record(record):
+    return record.name != CONSOLE_LOGGER and record.name != EVENT_LOGGER
+
+def console_for(prefix=""):
+    # console_for("BR28: ").info("Sent to ESP: %s", names) prints "BR28: Sent to ESP: ..."
+    return logging.LoggerAdapter(console_log, {"console_prefix": prefix})
+
+console = console_for().info
+
+def setup_logging(log_prefix, queued=True, quiet_console=False, compression=LOG_COMPRESSION):
+    global log_listener
+
+    if not os.path.exists(LOG_DIR):
+        os.makedirs(LOG_DIR)
+
+    now = datetime.now()
+    date_time = now.strftime("%d-%m-%Y_%H-%M-%S")
+    log_file_name = log_prefix + date_time + "_log.log"
+
+    file_handler = CompressingRotatingFileHandler(os.path.join(LOG_DIR, log_file_name), compression=compression)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+    file_handler.addFilter(is_log_record)
+
+    event_handler = CompressingRotatingFileHandler(os.path.join(LOG_DIR, log_prefix + date_time + "_events.jsonl"), compression=compression)
+    event_handler.setFormatter(EventFormatter())
+    event_handler.addFilter(is_event_record)
+    log_files.extend((file_handler, event_handler))
+
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+    stdout_handler.addFilter(is_console_record)
+
+    logging.getLogger().setLevel(logging.DEBUG)
+    console_log.setLevel(logging.INFO)
+    event_log.setLevel(logging.INFO) # Left unset (so off) if logging is never set up, an event then costs one level check
+
+    if queued or quiet_console:
+        log_queue = queue.SimpleQueue()
+        queue_handler = DeferredQueueHandler(log_queue)
+        log_listener = logging.handlers.QueueListener(log_queue, file_handler, event_handler, stdout_handler)
+        log_listener.start()
+
+    logging.getLogger().addHandler(queue_handler if queued else file_handler)
+    event_log.addHandler(queue_handler if queued else event_handler)
+    console_log.addHandler(queue_handler if quiet_console else stdout_handler)
+
+def stop_logging():
+    # Writes out whatever is still queued, call on the way out or the last lines are lost
+    global log_listener
+
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+    for log_file in log_files:
+        log_file.close()
+    log_files.clear()
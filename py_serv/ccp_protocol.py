@@ -0,0 +1,409 @@
+import json, logging, re, time
+from collections import namedtuple
+
+# Shared CCP <-> ESP and CCP <-> MCP semantics, every CCP engine (threaded or asyncio) works these out the same way
+
+# BladeRunner Commands, the ESP path works on these raw byte values end to end
+bladeRunnerCommands = {
+    "STOP": 0x00,
+    "FORWARD-SLOW": 0x01,
+    "FORWARD-FAST": 0x02,
+    "REVERSE-SLOW": 0x03,
+    "REVERSE-FAST": 0x04,
+    "DOORS-OPEN": 0x05,
+    "DOORS-CLOSE": 0x06,
+    "SET-SLOW-SPEED": 0x07,
+    "SET-FAST-SPEED": 0x08,
+    "DISCONNECT": 0xFF
+}
+# Each command pre-encoded once as the immutable bytes that go on the wire
+ESP_CMD_FRAMES = {cmd: bytes((cmd,)) for cmd in bladeRunnerCommands.values()}
+ESP_CMD_NAMES = {cmd: name for name, cmd in bladeRunnerCommands.items()} # Only for logging
+
+class EspCmdNames:
+    # Log arg for a command sequence, only turned into "STOP, DOOR-CLOSE" if the line actually gets written
+    __slots__ = ("esp_cmds",)
+
+    def __init__(self, esp_cmds):
+        self.esp_cmds = tuple(esp_cmds)
+
+    def __str__(self):
+        return ", ".join(ESP_CMD_NAMES[esp_cmd] for esp_cmd in self.esp_cmds)
+
+# ESP frames are [action, cmd], action is one of these
+ESP_ACK = 0xAA
+ESP_ALERT = 0xFF
+ESP_FRAME_SIZE = 2
+
+# Link health ping, the ESP ACKs it straight back ([ESP_ACK, ESP_PING]) without touching the BR
+ESP_PING = 0xEC
+ESP_PING_FRAME = bytes((ESP_PING,))
+ESP_RECV_CHUNK = 4096 # Read as much as the ESP has sent in one go, a burst of alerts shouldn't take a recv each
+
+JAVA_LINE_END = "\r\n"
+
+# MCP Specific Variables
+BR_STATUS = ["STOPC", "STOPO", "FSLOWC", "FFASTC", "RSLOWC", "ERR", "OFLN"]
+
+MCP_CMDS = ["STOPC", "STOPO", "FSLOWC", "FFASTC", "RSLOWC", "DISCONNECT"]
+
+MCP_MSG_REPLIES = {"EXEC":"AKEX",
+                   "STRQ": "STAT"}
+
+# ESP Semantics
+
+def esp_ack_transition(cmd, door_open, last_cmd):
+    # Works out where an ACK for cmd leaves the BR
+    # Returns (new status, new door state, log level, log message)
+    match cmd:
+        case 0x00: # STOP
+            if door_open:
+                return BR_STATUS[1], door_open, logging.DEBUG, "BR Successfully Stopped, Door Open"
+            else:
+                return BR_STATUS[0], door_open, logging.DEBUG, "BR Successfully Stopped, Door Closed"
+        case 0x01: # FORWARD-SLOW
+            if door_open:
+                return BR_STATUS[5], door_open, logging.DEBUG, "BR Now moving Forward Slow with Door Open, ERR"
+            else:
+                return BR_STATUS[2], door_open, logging.DEBUG, "BR Now Moving Forward Slow, searching for IR"
+        case 0x02: # FORWARD-FAST
+            if door_open:
+                return BR_STATUS[5], door_open, logging.DEBUG, "BR Now Moving Forward Fast with Door Open, ERR"
+            else:
+                return BR_STATUS[3], door_open, logging.DEBUG, "BR Now Moving Forward Fast"
+        case 0x03: # REVERSE-SLOW
+            if door_open:
+                return BR_STATUS[5], door_open, logging.DEBUG, "BR Now Reversing Slow with Door Open, ERR"
+            else:
+                return BR_STATUS[4], door_open, logging.DEBUG, "BR Now Reversing Slow, searching for IR"
+        case 0x04: # REVERSE-FAST
+            return BR_STATUS[5], door_open, logging.DEBUG, "BR Now Reversing Fast, How did we get here..." # This shouldn't ever get called but eh
+        case 0x05: # DOORS-OPEN
+            if last_cmd == bladeRunnerCommands["STOP"]:
+                return BR_STATUS[1], True, logging.DEBUG, "BR Door now Open"
+            else:
+                return BR_STATUS[5], True, logging.CRITICAL, "BR Triggered Door Open State without Prior Stop state, ERR"
+        case 0x06: # DOORS-CLOSE, all other commands should ensure the door is shut
+            # Technically this can be called after any command but we'd prefer after a stop
+            return BR_STATUS[0], False, logging.DEBUG, "BR Door now Closed"
+        case _:
+            return BR_STATUS[5], door_open, logging.CRITICAL, "BR has returned non-standard but valid command"
+
+def esp_alert_transition(cmd):
+    # Works out what an ALERT from the ESP means for the BR
+    # Returns (new status or None if the alert doesn't change it, log level, log message or None if unknown)
+    if (cmd == 0xAA):
+        return BR_STATUS[0], logging.DEBUG, "BladeRunner aligned to station"
+    elif (cmd == 0xAB):
+        return BR_STATUS[0], logging.CRITICAL, "BladeRunner has had a collision!"
+    elif (cmd == 0xFE):
+        return BR_STATUS[5], logging.CRITICAL, "BladeRunner has lost power!"
+    elif (cmd == 0xFF):
+        return BR_STATUS[6], logging.CRITICAL, "BladeRunner is now Offline!"
+    elif (cmd == 0xBA):
+        return None, logging.DEBUG, "BladeRunner is reporting Battery Voltage"
+
+    return None, logging.DEBUG, None
+
+# BladeRunner State Machine
+# A BR's state is one small int packing its status, whether its door is open and whether the last command it ACKed was
+# a STOP, which is everything a transition depends on. Events are the ACKs and ALERTs the ESP can send plus the two the
+# CCP raises itself, and every (state, event) pair is worked out once at import from the rules above into one flat table,
+# so a transition is one index and nothing is decided per frame
+# A transition the rules say puts the BR in ERR off the back of an ACK (moving with the door open, DOORS-OPEN without
+# a STOP first, a command the BR shouldn't be carrying out) is invalid and counted
+
+BR_STATE_FLAGS = 4 # door open * 2 + last command STOP
+BR_STATES = len(BR_STATUS) * BR_STATE_FLAGS
+BR_STATE_INITIAL = BR_STATUS.index("STOPC") * BR_STATE_FLAGS + 1 # Door closed, last command STOP
+
+BR_ALERTS = (0xAA, 0xAB, 0xFE, 0xFF, 0xBA) # ALERT codes esp_alert_transition knows, any other is ignored
+BR_EVENT_ACK = {cmd: event for event, cmd in enumerate(bladeRunnerCommands.values())}
+BR_EVENT_ALERT = {alert: len(BR_EVENT_ACK) + event for event, alert in enumerate(BR_ALERTS)}
+BR_EVENT_ACK_TIMEOUT = len(BR_EVENT_ACK) + len(BR_EVENT_ALERT) # A command used up its retries
+BR_EVENT_ESP_LOST = BR_EVENT_ACK_TIMEOUT + 1 # The ESP link went while the MCP is expecting to hear about the BR
+BR_EVENTS = BR_EVENT_ESP_LOST + 1
+BR_EVENT_NAMES = ([f"ACK {ESP_CMD_NAMES[cmd]}" for cmd in BR_EVENT_ACK] + [f"ALERT {alert:02X}" for alert in BR_EVENT_ALERT] +
+                  ["ACK TIMEOUT", "ESP LOST"])
+
+BrTransition = namedtuple("BrTransition", ["state", "status", "door_open", "ack_cmd", "level", "message", "invalid"])
+# What anyone outside the core reads, a new one replaces the last on every transition and is never changed after
+# last_ack_ns is when last_cmd was ACKed (None til the first ACK), sequence_number counts transitions so a reader can tell it's moved
+BrSnapshot = namedtuple("BrSnapshot", ["status", "door_open", "last_cmd", "last_ack_ns", "sequence_number"])
+new_tuple = tuple.__new__ # Builds a BrSnapshot from a plain tuple in half the time of calling BrSnapshot(), it's made on every transition
+
+def build_br_transitions():
+    table = [None] * (BR_STATES * BR_EVENTS)
+
+    for state in range(BR_STATES):
+        status = BR_STATUS[state // BR_STATE_FLAGS]
+        door_open = bool(state & 2)
+        last_stop = bool(state & 1)
+
+        def transition(event, next_status, next_door_open, next_last_stop, level, message, ack_cmd=None, invalid=False):
+            next_state = BR_STATUS.index(next_status) * BR_STATE_FLAGS + next_door_open * 2 + next_last_stop
+            table[state * BR_EVENTS + event] = BrTransition(next_state, next_status, next_door_open, ack_cmd, level, message, invalid)
+
+        for cmd, event in BR_EVENT_ACK.items():
+            next_status, next_door_open, level, message = esp_ack_transition(cmd, door_open, bladeRunnerCommands["STOP"] if last_stop else None)
+            transition(event, next_status, next_door_open, cmd == bladeRunnerCommands["STOP"], level, message, cmd, next_status == BR_STATUS[5])
+
+        for alert, event in BR_EVENT_ALERT.items():
+            alert_status, level, message = esp_alert_transition(alert)
+            transition(event, status if alert_status is None else alert_status, door_open, last_stop, level, message)
+
+        # The CCP logs these itself, the table only moves the BR to ERR
+        transition(BR_EVENT_ACK_TIMEOUT, BR_STATUS[5], door_open, last_stop, None, None)
+        transition(BR_EVENT_ESP_LOST, BR_STATUS[5], door_open, last_stop, None, None)
+
+    return table
+
+BR_TRANSITIONS = build_br_transitions()
+
+class BrState:
+    # Everything one BR's status depends on, kept small so a host (or a benchmark) can hold thousands
+    # Only the core calls apply(), anyone else reads snapshot once and uses that, rebinding it is atomic so no reader
+    # ever needs a lock or sees half of one transition and half of the next
+    __slots__ = ("state", "snapshot", "invalid_transitions")
+
+    def __init__(self):
+        self.state = BR_STATE_INITIAL
+        self.snapshot = BrSnapshot(BR_STATUS[BR_STATE_INITIAL // BR_STATE_FLAGS], False, bladeRunnerCommands["STOP"], None, 0)
+        self.invalid_transitions = None # {"STOPC + ACK DOORS-OPEN": count}, only made once there is one
+
+    def apply(self, event, now_ns=None):
+        transition = BR_TRANSITIONS[self.state * BR_EVENTS + event]
+        snapshot = self.snapshot
+        if transition.invalid:
+            if self.invalid_transitions is None:
+                self.invalid_transitions = {}
+            invalid = f"{snapshot.status} + {BR_EVENT_NAMES[event]}"
+            self.invalid_transitions[invalid] = self.invalid_transitions.get(invalid, 0) + 1
+
+        self.state = transition.state
+        if transition.ack_cmd is None:
+            self.snapshot = new_tuple(BrSnapshot, (transition.status, transition.door_open, snapshot.last_cmd, snapshot.last_ack_ns,
+                                                   snapshot.sequence_number + 1))
+        else:
+            if now_ns is None:
+                now_ns = time.monotonic_ns()
+            self.snapshot = new_tuple(BrSnapshot, (transition.status, transition.door_open, transition.ack_cmd, now_ns,
+                                                   snapshot.sequence_number + 1))
+        return transition
+
+    def invalid_summary(self):
+        return dict(self.invalid_transitions) if self.invalid_transitions is not None else {}
+
+# ESP Frame Dispatch
+# Every possible frame (action << 8 | cmd) maps straight to (kind, cmd, event), built once at import
+# so handling a frame is one list index, no hex strings or list searches per frame
+# event is the BR state machine event for an ACK or a known ALERT, None for anything else
+
+ESP_FRAME_BAD_ACTION = 0
+ESP_FRAME_UNKNOWN_ACK = 1
+ESP_FRAME_ACK = 2
+ESP_FRAME_ALERT = 3
+ESP_FRAME_PING = 4
+
+def build_esp_frame_table():
+    bad_action = (ESP_FRAME_BAD_ACTION, None, None)
+    table = [bad_action] * (256 * 256)
+
+    for cmd in range(256):
+        table[ESP_ACK << 8 | cmd] = (ESP_FRAME_UNKNOWN_ACK, cmd, None)
+        table[ESP_ALERT << 8 | cmd] = (ESP_FRAME_ALERT, cmd, BR_EVENT_ALERT.get(cmd))
+
+    for cmd, event in BR_EVENT_ACK.items():
+        table[ESP_ACK << 8 | cmd] = (ESP_FRAME_ACK, cmd, event)
+
+    table[ESP_ACK << 8 | ESP_PING] = (ESP_FRAME_PING, ESP_PING, None)
+
+    return table
+
+ESP_FRAME_TABLE = build_esp_frame_table()
+
+class EspFrameDecoder:
+    # TCP is free to split or merge the ESP's 2 byte frames, this buffers the stream and only ever hands back whole frames
+    def __init__(self, chunk_size=ESP_RECV_CHUNK):
+        self.recv_buffer = bytearray(chunk_size) # Reused for every recv so reading doesn't allocate
+        self.recv_view = memoryview(self.recv_buffer)
+        self.pending = bytearray() # Partial frame left over from the last read
+
+    def reset(self):
+        # Anything half received belongs to a connection that's gone
+        self.pending.clear()
+
+    def recv(self, sock):
+        # One recv into the reusable buffer, the view is only good til the next recv
+        nbytes = sock.recv_into(self.recv_view)
+        if nbytes == 0:
+            # recv only returns nothing once the ESP has closed its end
+            raise ConnectionResetError
+
+        return self.recv_view[:nbytes]
+
+    def recv_frames(self, sock):
+        # One recv, returns every frame it completed (possibly none)
+        return self.feed(self.recv(sock))
+
+    def feed(self, data):
+        if self.pending:
+            self.pending += data
+            data = self.pending
+            self.pending = bytearray()
+
+        # Frames come out as action << 8 | cmd, ready to index ESP_FRAME_TABLE with
+        whole = len(data) - (len(data) % ESP_FRAME_SIZE)
+        frames = [data[i] << 8 | data[i + 1] for i in range(0, whole, ESP_FRAME_SIZE)]
+
+        if whole < len(data):
+            self.pending += data[whole:]
+
+        return frames
+
+# MCP Semantics
+
+def mcp_exec_commands(action, door_open):
+    # Ordered BladeRunner commands needed to carry out an MCP EXEC action, None if the action isn't one we know
+    match action:
+        case "STOPC":
+            cmds = [bladeRunnerCommands["STOP"]]
+            if door_open:
+                cmds.append(bladeRunnerCommands["DOORS-CLOSE"])
+            return cmds
+        case "STOPO":
+            cmds = [bladeRunnerCommands["STOP"]]
+            if not door_open:
+                cmds.append(bladeRunnerCommands["DOORS-OPEN"])
+            return cmds
+        case "FSLOWC":
+            return ([bladeRunnerCommands["DOORS-CLOSE"]] if door_open else []) + [bladeRunnerCommands["FORWARD-SLOW"]]
+        case "FFASTC":
+            return ([bladeRunnerCommands["DOORS-CLOSE"]] if door_open else []) + [bladeRunnerCommands["FORWARD-FAST"]]
+        case "RSLOWC":
+            return ([bladeRunnerCommands["DOORS-CLOSE"]] if door_open else []) + [bladeRunnerCommands["REVERSE-SLOW"]]
+        case "DISCONNECT": # When disconnecting we no longer shutdown, instead wait for BR to be removed and it will ping when shutting off
+            return [bladeRunnerCommands["DISCONNECT"]]
+        case _:
+            return None
+
+def encode_esp_cmds(esp_cmds):
+    # A whole command sequence in one buffer, so it goes out in one write and one TCP segment
+    return b"".join(ESP_CMD_FRAMES[esp_cmd] for esp_cmd in esp_cmds)
+
+def build_mcp_exec_plans():
+    # Every EXEC action's command sequence for both door states, along with its pre-encoded single write payload
+    plans = {}
+    for action in MCP_CMDS:
+        for door_open in (False, True):
+            esp_cmds = tuple(mcp_exec_commands(action, door_open))
+            plans[(action, door_open)] = (esp_cmds, encode_esp_cmds(esp_cmds))
+    return plans
+
+MCP_EXEC_PLANS = build_mcp_exec_plans()
+
+def mcp_exec_plan(action, door_open):
+    # (commands, payload) for an EXEC action, None if the action isn't one we know
+    if not isinstance(action, str):
+        return None
+    return MCP_EXEC_PLANS.get((action, door_open))
+
+def mcp_exec_identity(mcp_msg):
+    # What makes two EXECs the same one, None if the MCP didn't number it since then a repeat can't be told from a new request
+    sequence_number = mcp_msg.get("sequence_number")
+    action = mcp_msg.get("action")
+    if sequence_number is None or not isinstance(action, str):
+        return None
+    return (sequence_number, action)
+
+def mcp_exec_needs_akex(action):
+    # Every known EXEC is acknowledged except DISCONNECT, the BR pings us itself when it goes
+    return action != "DISCONNECT"
+
+def create_mcp_msg(client_id, message, sequence_number, status=None):
+    # Key order matters to keep the wire format identical across engines
+    mcp_msg = {
+        "client_type": "CCP",
+        "message": message,
+        "client_id": client_id,
+        "sequence_number": sequence_number
+    }
+
+    if status is not None:
+        mcp_msg["status"] = status
+
+    return mcp_msg
+
+def encode_mcp_msg(mcp_msg):
+    return (json.dumps(mcp_msg) + JAVA_LINE_END).encode('utf-8')
+
+# Pre-encoded MCP replies
+# A BR only ever sends a handful of message shapes and only the sequence number changes between sends,
+# so each shape is encoded once and the sequence number spliced in per send
+
+MCP_SEQ_MARKER = "__sequence_number__"
+
+class McpMsgTemplates:
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.templates = {} # (message, status) -> (bytes before the sequence number, bytes after it)
+
+        for status in BR_STATUS:
+            self.template("STAT", status)
+        for message in ("CCIN", "AKEX", "NOIP"):
+            self.template(message)
+
+    def template(self, message, status=None):
+        key = (message, status)
+        template = self.templates.get(key)
+        if template is None:
+            # Built with encode_mcp_msg itself so the wire format can't drift from it
+            marker = encode_mcp_msg(MCP_SEQ_MARKER)[:-len(JAVA_LINE_END)]
+            prefix, suffix = encode_mcp_msg(create_mcp_msg(self.client_id, message, MCP_SEQ_MARKER, status)).split(marker)
+            template = self.templates[key] = (prefix, suffix)
+        return template
+
+    def encode(self, message, sequence_number, status=None):
+        # Byte for byte what encode_mcp_msg(create_mcp_msg(...)) gives, minus the dict and json.dumps
+        prefix, suffix = self.templates.get((message, status)) or self.template(message, status)
+        return b"%b%d%b" % (prefix, sequence_number, suffix)
+
+def decode_mcp_msg(data, client_id):
+    # Returns (parsed message, None) or (None, reason it was rejected)
+    try:
+        mcp_msg = json.loads(data)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None, "Received from MCP, but failed to parse JSON"
+
+    if not isinstance(mcp_msg, dict) or mcp_msg.get("client_id") != client_id or mcp_msg.get("client_type") != "CCP":
+        return None, "Received from MCP, but incorrect client id or type"
+
+    if not isinstance(mcp_msg.get("message"), str):
+        return None, "Received from MCP, but message is missing or not a string"
+
+    # Sequence numbers key our in flight and EXEC tables, so anything but an int (or none at all) goes no further
+    sequence_number = mcp_msg.get("sequence_number")
+    if sequence_number is not None and (not isinstance(sequence_number, int) or isinstance(sequence_number, bool)):
+        return None, "Received from MCP, but sequence number is not an integer"
+
+    return mcp_msg, None
+
+MCP_CLIENT_TYPE_FIELD = re.compile(rb'"client_type"\s*:\s*"CCP"')
+
+class McpMsgFilter:
+    # Cheap checks on the raw datagram before json.loads, so traffic for other BRs and obvious junk never gets parsed
+    # An id the MCP sent \u-escaped won't match, the MCP has never done that
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.client_id_bytes = json.dumps(client_id).encode('utf-8') # Quoted, so BR2 can't match BR28
+        self.client_id_field = re.compile(rb'"client_id"\s*:\s*' + re.escape(self.client_id_bytes))
+
+    def decode(self, data):
+        # Same results as decode_mcp_msg, except (None, None) for traffic that's simply not ours and isn't worth a log
+        if self.client_id_bytes not in data:
+            return None, None
+
+        if self.client_id_field.search(data) is None or MCP_CLIENT_TYPE_FIELD.search(data) is None:
+            return None, "Received from MCP, but incorrect client id or type"
+
+        return decode_mcp_msg(data, self.client_id)
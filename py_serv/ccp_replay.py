@@ -0,0 +1,257 @@
+import argparse, difflib, json, logging, time
+from ccp_protocol import ESP_CMD_NAMES, ESP_ACK, ESP_ALERT, ESP_PING, ESP_PING_FRAME
+from ccp_capture import (read_capture, CAPTURE_KIND_NAMES, CAPTURE_OUTPUTS, CAPTURE_ESP_IN, CAPTURE_ESP_OUT, CAPTURE_MCP_IN, CAPTURE_MCP_OUT,
+                         CAPTURE_ESP_ATTACH, CAPTURE_ESP_DETACH)
+from ccp_host import BladeRunnerCCP
+from ccp_flight_recorder import FlightRecorder
+from ccp_logging import setup_logging, stop_logging, EventLog, CONSOLE_LOGGER
+from ccp_tracking import NS_PER_MS, NS_PER_S
+
+# Replays a capture from --capture through the host engine's own ESP and MCP handling, offline, no BR or MCP needed
+# Time is virtual, the CCP's monotonic clock reads the capture's timestamps, so ACK deadlines, retransmits, STAT refreshes and
+# the MCP watchdog fire where they did in the field whether the replay runs at 1x or flat out
+# Reports where the CCP's output differs from what the capture says it sent, and how long each input took to process
+# Usage: python ccp_replay.py capture.ccpcap [--speed 1] [--log]
+
+REPLAY_MCP_SERVER = ("127.0.0.1", 9) # Never actually sent to, the outbox isn't started
+REPLAY_DIVERGENCE_SHOWN = 20 # Differences printed before the rest are just counted
+
+class ReplayClock:
+    # Stands in for time.monotonic_ns while the replay runs, every deadline in the CCP is worked out from it
+    def __init__(self, now_ns):
+        self.now_ns = now_ns
+        self.real_monotonic_ns = None
+
+    def monotonic_ns(self):
+        return self.now_ns
+
+    def __enter__(self):
+        self.real_monotonic_ns = time.monotonic_ns
+        time.monotonic_ns = self.monotonic_ns
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        time.monotonic_ns = self.real_monotonic_ns
+
+class ReplayEspSocket:
+    # Stands in for the ESP connection, whatever the CCP writes has already been captured by the time it gets here
+    pass
+
+class ReplayEspLink:
+    # Stands in for EspConnectionManager, the capture says when the BR attached and when it went
+    def __init__(self, on_attach, on_detach):
+        self.on_attach = on_attach
+        self.on_detach = on_detach
+        self.client_socket = None
+
+    def attach(self):
+        self.client_socket = ReplayEspSocket()
+        self.on_attach()
+
+    def current(self):
+        return self.client_socket
+
+    def send(self, client_socket, data):
+        pass
+
+    def drop(self, client_socket):
+        if client_socket is None or client_socket is not self.client_socket:
+            return
+        self.client_socket = None
+        self.on_detach()
+
+    def close(self):
+        self.client_socket = None
+
+class ReplayOutput:
+    # Stands in for the CaptureWriter, keeps the CCP's output (stamped with the virtual clock) to compare with the capture
+    def __init__(self):
+        self.outputs = []
+
+    def write(self, kind, data=b""):
+        if kind in CAPTURE_OUTPUTS:
+            self.outputs.append((time.monotonic_ns(), kind, bytes(data)))
+
+    def close(self):
+        pass
+
+class ReplayFlightRecorder(FlightRecorder):
+    # Records as normal, but an ERR in the replay doesn't leave dumps behind unless the replay is logging
+    def dump(self, reason, wait=False, rate_limited=False):
+        return None
+
+class ReplayCCP(BladeRunnerCCP):
+    # The host engine's BR with its sockets and threads taken away, the replay loop does what the listeners and core thread would
+    def __init__(self, info, first_sequence_number=None, flight_dumps=False):
+        super().__init__(info["br"], 0, REPLAY_MCP_SERVER, info.get("esp_ping_interval"), None, info.get("mcp_silence_timeout"))
+        if not flight_dumps:
+            self.flight = ReplayFlightRecorder(self.client_id)
+            self.event = EventLog(self.client_id, self.flight)
+        self.esp_link = ReplayEspLink(self.esp_attached, self.esp_detached)
+        self.capture = ReplayOutput()
+        if first_sequence_number is not None:
+            # The field run picked its first sequence number at random, ours has to match for the MCP's acks to
+            self.sequence_number = first_sequence_number - 1
+
+    def feed(self, kind, data):
+        # One captured input, through the same methods the listener threads hand it to
+        if kind == CAPTURE_ESP_ATTACH:
+            self.esp_decoder.reset()
+            self.esp_link.attach()
+        elif kind == CAPTURE_ESP_DETACH:
+            self.esp_link.drop(self.esp_link.current())
+        elif kind == CAPTURE_ESP_IN:
+            self.esp_received(data)
+        elif kind == CAPTURE_MCP_IN:
+            self.mcp_received([data])
+        self.tick()
+
+    def tick(self):
+        # One core pass, it takes whatever the feed put in its inbox and anything that has come due
+        self.core_pass()
+
+def first_sequence_number(records):
+    for mono_ns, kind, data in records:
+        if kind == CAPTURE_MCP_OUT:
+            return json.loads(data).get("sequence_number")
+    return None
+
+def input_label(kind, data, esp_pending=b""):
+    # What per message timings are grouped under, ESP bytes are labelled by the frame they start (or finish)
+    if kind == CAPTURE_MCP_IN:
+        try:
+            return f"MCP {json.loads(data).get('message')}"
+        except ValueError:
+            return "MCP (bad JSON)"
+    if kind == CAPTURE_ESP_IN:
+        data = bytes(esp_pending) + data
+        if data[:2] == bytes((ESP_ACK, ESP_PING)):
+            return "ESP ping reply"
+        return {ESP_ACK: "ESP ACK", ESP_ALERT: "ESP ALERT"}.get(data[0], "ESP (bad action)")
+    return CAPTURE_KIND_NAMES[kind]
+
+def describe_output(kind, data):
+    if kind == CAPTURE_ESP_OUT:
+        if data == ESP_PING_FRAME:
+            return "ESP <- ping"
+        return "ESP <- " + ", ".join(ESP_CMD_NAMES.get(cmd, f"{cmd:02x}") for cmd in data)
+    return "MCP <- " + data.decode(errors="replace").strip()
+
+def replay(info, records, speed=0.0, flight_dumps=False):
+    # Returns what the CCP sent and {input label: [processing ns]}
+    start_ns = records[0][0] if records else 0
+    timings = {}
+    wall_start = time.perf_counter()
+
+    def pace(mono_ns):
+        if speed > 0:
+            wall_due = wall_start + (mono_ns - start_ns) / NS_PER_S / speed
+            wall_wait = wall_due - time.perf_counter()
+            if wall_wait > 0:
+                time.sleep(wall_wait)
+
+    def timed(label, handle, *args):
+        started_ns = time.perf_counter_ns()
+        handle(*args)
+        timings.setdefault(label, []).append(time.perf_counter_ns() - started_ns)
+
+    with ReplayClock(start_ns) as clock:
+        ccp = ReplayCCP(info, first_sequence_number(records), flight_dumps)
+
+        def run_deadlines(until_ns):
+            # Everything the CCP had scheduled before until_ns happens first, in order
+            last_deadline_ns = None
+            while True:
+                deadline_ns = ccp.next_core_deadline_ns()
+                if deadline_ns is None or deadline_ns > until_ns or deadline_ns == last_deadline_ns:
+                    return
+                last_deadline_ns = deadline_ns
+                clock.now_ns = max(clock.now_ns, deadline_ns)
+                pace(clock.now_ns)
+                timed("timer", ccp.tick)
+
+        for mono_ns, kind, data in records:
+            if kind in CAPTURE_OUTPUTS:
+                continue
+            run_deadlines(mono_ns)
+            clock.now_ns = max(clock.now_ns, mono_ns)
+            pace(mono_ns)
+            timed(input_label(kind, data, ccp.esp_decoder.pending), ccp.feed, kind, data)
+
+        if records:
+            run_deadlines(records[-1][0])
+
+    return ccp.capture.outputs, timings
+
+def report_divergence(start_ns, captured, replayed):
+    # Returns how many outputs differ, lined up with difflib so one extra or missing message doesn't throw off the rest
+    captured_keys = [(kind, data) for mono_ns, kind, data in captured]
+    replayed_keys = [(kind, data) for mono_ns, kind, data in replayed]
+    matcher = difflib.SequenceMatcher(None, captured_keys, replayed_keys, autojunk=False)
+
+    divergent = 0
+    largest_shift_ns = 0
+    for tag, captured_from, captured_to, replayed_from, replayed_to in matcher.get_opcodes():
+        if tag == "equal":
+            for offset in range(captured_to - captured_from):
+                shift_ns = abs(captured[captured_from + offset][0] - replayed[replayed_from + offset][0])
+                largest_shift_ns = max(largest_shift_ns, shift_ns)
+            continue
+
+        for mono_ns, kind, data in captured[captured_from:captured_to]:
+            divergent += 1
+            if divergent <= REPLAY_DIVERGENCE_SHOWN:
+                print(f"  {(mono_ns - start_ns) / NS_PER_MS:10.1f} ms  captured only: {describe_output(kind, data)}")
+        for mono_ns, kind, data in replayed[replayed_from:replayed_to]:
+            divergent += 1
+            if divergent <= REPLAY_DIVERGENCE_SHOWN:
+                print(f"  {(mono_ns - start_ns) / NS_PER_MS:10.1f} ms  replay only:   {describe_output(kind, data)}")
+
+    if divergent > REPLAY_DIVERGENCE_SHOWN:
+        print(f"  ... and {divergent - REPLAY_DIVERGENCE_SHOWN} more")
+    print(f"Matched outputs were at most {largest_shift_ns / NS_PER_MS:.2f} ms apart in the field and the replay")
+    return divergent
+
+def report_timings(timings):
+    print(f"{'input':<18}{'count':>8}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}{'max us':>10}")
+    for label, durations_ns in sorted(timings.items()):
+        durations_ns = sorted(durations_ns)
+        count = len(durations_ns)
+        print(f"{label:<18}{count:>8}{sum(durations_ns) / count / 1000:>10.1f}{durations_ns[count // 2] / 1000:>10.1f}"
+              f"{durations_ns[min(count - 1, count * 99 // 100)] / 1000:>10.1f}{durations_ns[-1] / 1000:>10.1f}")
+
+def main_logic():
+    parser = argparse.ArgumentParser(description="Replay a CCP capture offline")
+    parser.add_argument("capture_file")
+    parser.add_argument("--speed", type=float, default=0.0, help="1 for real time, 0 (default) for as fast as possible")
+    parser.add_argument("--log", action="store_true", help="log the replay (and write flight dumps) like a live CCP would, so the timings include it")
+    args = parser.parse_args()
+
+    info, records = read_capture(args.capture_file)
+    if args.log:
+        setup_logging("replay_ccp", quiet_console=True)
+    else:
+        # Unconfigured, only warnings and worse would reach the terminal and bury the report
+        logging.getLogger().addHandler(logging.NullHandler())
+        logging.getLogger(CONSOLE_LOGGER).addHandler(logging.NullHandler())
+
+    try:
+        replayed, timings = replay(info, records, args.speed, args.log)
+    finally:
+        stop_logging()
+
+    captured = [record for record in records if record[1] in CAPTURE_OUTPUTS]
+    start_ns = records[0][0] if records else 0
+    duration_s = (records[-1][0] - start_ns) / NS_PER_S if records else 0
+
+    print(f"{info['br']}: {len(records)} records over {duration_s:.1f}s, captured by the {info.get('engine')} engine")
+    divergent = report_divergence(start_ns, captured, replayed)
+    if divergent:
+        print(f"DIVERGED: {divergent} of {len(captured)} captured / {len(replayed)} replayed outputs differ")
+    else:
+        print(f"No divergence, all {len(captured)} outputs match")
+    report_timings(timings)
+    return 1 if divergent else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main_logic())
@@ -0,0 +1,506 @@
+import threading, time
+from ccp_protocol import bladeRunnerCommands
+
+# Delivery tracking for the CCP links, shared by every CCP engine
+
+NS_PER_MS = 1_000_000
+NS_PER_S = 1_000_000_000
+
+# ESP ACK Tracking
+
+# The ESP only ACKs these, anything else (DISCONNECT) is fire and forget
+ESP_ACKED_CMDS = {cmd for cmd in bladeRunnerCommands.values() if cmd <= bladeRunnerCommands["SET-FAST-SPEED"]}
+
+# A command in one of these replaces anything still pending from the same group, only the latest thing asked for is ever resent
+# STOP and every drive command are one group, so a STOP also clears an unACKed drive and a drive clears an unACKed STOP
+# The two speed settings are separate values, so they never replace each other
+ESP_SUPERSEDE_GROUPS = (
+    frozenset(bladeRunnerCommands[name] for name in ("STOP", "FORWARD-SLOW", "FORWARD-FAST", "REVERSE-SLOW", "REVERSE-FAST")),
+    frozenset(bladeRunnerCommands[name] for name in ("DOORS-OPEN", "DOORS-CLOSE"))
+)
+ESP_SUPERSEDES = {cmd: group for group in ESP_SUPERSEDE_GROUPS for cmd in group}
+
+ACK_DEADLINE = 0.5 # Seconds the ESP gets to ACK a command before we retransmit it
+ACK_DEADLINES = {
+    # Door moves finish before the ESP ACKs, and closing waits on the door sensors
+    bladeRunnerCommands["DOORS-OPEN"]: 5.0,
+    bladeRunnerCommands["DOORS-CLOSE"]: 5.0
+}
+ACK_MAX_RETRIES = 2 # Retransmits before we give up on the BR and escalate to ERR
+
+class LatencyStats:
+    # Running latency figures for one kind of exchange, all in ns
+    __slots__ = ("count", "last_ns", "min_ns", "max_ns", "total_ns")
+
+    def __init__(self):
+        self.count = 0
+        self.last_ns = 0
+        self.min_ns = 0
+        self.max_ns = 0
+        self.total_ns = 0
+
+    def record(self, latency_ns):
+        if self.count == 0 or latency_ns < self.min_ns:
+            self.min_ns = latency_ns
+        if latency_ns > self.max_ns:
+            self.max_ns = latency_ns
+        self.count += 1
+        self.last_ns = latency_ns
+        self.total_ns += latency_ns
+
+    def summary(self):
+        mean_ns = self.total_ns / self.count if self.count else 0
+        return {"count": self.count, "last_ms": self.last_ns / NS_PER_MS, "min_ms": self.min_ns / NS_PER_MS,
+                "mean_ms": mean_ns / NS_PER_MS, "max_ms": self.max_ns / NS_PER_MS}
+
+class PendingAck:
+    __slots__ = ("cmd", "sent_ns", "deadline_ns", "retries", "behind")
+
+    def __init__(self, cmd, sent_ns, deadline_ns, behind=None):
+        self.cmd = cmd
+        self.sent_ns = sent_ns
+        self.deadline_ns = deadline_ns
+        self.retries = 0
+        self.behind = behind # Command the ESP has to finish before it gets to this one, None if it starts straight away
+
+class PendingAckTable:
+    # Commands sent to the ESP that haven't been ACKed yet, keyed by command
+    # A repeat of a command that is still pending just refreshes its entry, the ESP's one ACK covers both
+    # A newer command from the same supersede group drops the old entry, so a STOP is never followed by a resend of the drive it stopped
+    # The ESP works through its commands one at a time and a door move blocks it til it's done, so a command sent while another
+    # is still pending only starts its deadline once that one's is up, or from its ACK if that comes first
+    def __init__(self, deadline=ACK_DEADLINE, deadlines=ACK_DEADLINES, max_retries=ACK_MAX_RETRIES):
+        self.deadline_ns = int(deadline * NS_PER_S)
+        self.deadlines_ns = {cmd: int(cmd_deadline * NS_PER_S) for cmd, cmd_deadline in deadlines.items()}
+        self.max_retries = max_retries
+        self.pending = {}
+        self.latency = {} # cmd -> LatencyStats for send to ACK
+
+    def __len__(self):
+        return len(self.pending)
+
+    def sent(self, cmd, now_ns=None):
+        if cmd not in ESP_ACKED_CMDS:
+            return
+
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+
+        for superseded in ESP_SUPERSEDES.get(cmd, ()):
+            self.pending.pop(superseded, None)
+        self.pending.pop(cmd, None)
+        self.queue(PendingAck(cmd, now_ns, now_ns), now_ns)
+
+    def retransmitted(self, entry, now_ns=None):
+        # Same entry goes back in with a fresh deadline, retries carried over
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+
+        entry.retries += 1
+        entry.sent_ns = now_ns
+        self.queue(entry, now_ns)
+
+    def queue(self, entry, now_ns):
+        # Deadline counts from the end of the latest deadline still pending, that command is ahead of this one on the ESP
+        ahead = max(self.pending.values(), key=lambda pending: pending.deadline_ns, default=None)
+        if ahead is not None and ahead.deadline_ns > now_ns:
+            entry.behind = ahead.cmd
+            entry.deadline_ns = ahead.deadline_ns + self.deadlines_ns.get(entry.cmd, self.deadline_ns)
+        else:
+            entry.behind = None
+            entry.deadline_ns = now_ns + self.deadlines_ns.get(entry.cmd, self.deadline_ns)
+        self.pending[entry.cmd] = entry
+
+    def acked(self, cmd, now_ns=None):
+        # Returns the send to ACK latency in ns, None if nothing was waiting on this ACK (duplicate or unsolicited)
+        entry = self.pending.pop(cmd, None)
+        if entry is None:
+            return None
+
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        latency_ns = now_ns - entry.sent_ns
+
+        # Whatever was waiting on this one starts now, its latency and deadline count from here
+        for queued in self.pending.values():
+            if queued.behind == cmd:
+                queued.behind = None
+                queued.sent_ns = now_ns
+                queued.deadline_ns = min(queued.deadline_ns, now_ns + self.deadlines_ns.get(queued.cmd, self.deadline_ns))
+
+        # Can't tell which transmission a retried command's ACK belongs to, so only first time ACKs count towards latency
+        if entry.retries == 0:
+            stats = self.latency.get(cmd)
+            if stats is None:
+                stats = self.latency[cmd] = LatencyStats()
+            stats.record(latency_ns)
+
+        return latency_ns
+
+    def expired(self, now_ns=None):
+        # Pops and returns every entry past its deadline, caller decides to retransmit or escalate
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+
+        expired = [entry for entry in self.pending.values() if entry.deadline_ns <= now_ns]
+        for entry in expired:
+            del self.pending[entry.cmd]
+        return expired
+
+    def next_deadline_ns(self):
+        if not self.pending:
+            return None
+        return min(entry.deadline_ns for entry in self.pending.values())
+
+    def clear(self):
+        # The link these were sent on is gone, nothing will ACK them now
+        self.pending.clear()
+
+    def latency_summary(self):
+        return {cmd: stats.summary() for cmd, stats in self.latency.items()}
+
+def seconds_until(deadline_ns, now_ns=None):
+    # Wait timeout helper, never negative
+    if now_ns is None:
+        now_ns = time.monotonic_ns()
+    return max(0.0, (deadline_ns - now_ns) / NS_PER_S)
+
+# MCP In-Flight Tracking
+
+MCP_ACKED_BY = {"AKST": "STAT", "AKIN": "CCIN"} # MCP ack -> the message of ours it acknowledges, nothing else we send is acked
+MCP_RETRY_BASE = 0.25 # Seconds before the first retransmit, doubled for each one after
+MCP_RETRY_CAP = 4.0
+MCP_MAX_RETRIES = 5 # Retransmits before we give up on a message
+MCP_INFLIGHT_MAX = 32 # Hard cap on the table, the oldest entry goes if the MCP stops acking altogether
+
+class McpInFlight:
+    __slots__ = ("message", "sequence_number", "payload", "sent_ns", "deadline_ns", "retries")
+
+    def __init__(self, message, sequence_number, payload, sent_ns, deadline_ns):
+        self.message = message
+        self.sequence_number = sequence_number
+        self.payload = payload # Retransmits go out byte for byte the same, sequence number included
+        self.sent_ns = sent_ns
+        self.deadline_ns = deadline_ns
+        self.retries = 0
+
+class McpInFlightTable:
+    # Messages sent to the MCP that haven't been acked yet, keyed by sequence number and kept oldest first
+    def __init__(self, retry_base=MCP_RETRY_BASE, retry_cap=MCP_RETRY_CAP, max_retries=MCP_MAX_RETRIES, max_size=MCP_INFLIGHT_MAX):
+        self.retry_base_ns = int(retry_base * NS_PER_S)
+        self.retry_cap_ns = int(retry_cap * NS_PER_S)
+        self.max_retries = max_retries
+        self.max_size = max_size
+        self.inflight = {}
+        self.latency = {} # message -> LatencyStats for send to ack
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.inflight)
+
+    def backoff_ns(self, retries):
+        return min(self.retry_base_ns << retries, self.retry_cap_ns)
+
+    def sent(self, message, sequence_number, payload, now_ns=None):
+        if message not in MCP_ACKED_BY.values():
+            return
+
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+
+        # A newer STAT (or CCIN) supersedes any of its kind still in flight, no point retransmitting a status that's already stale
+        # or piling up registrations while the MCP is away
+        for stale in [entry.sequence_number for entry in self.inflight.values() if entry.message == message]:
+            del self.inflight[stale]
+
+        while len(self.inflight) >= self.max_size:
+            del self.inflight[next(iter(self.inflight))]
+            self.evicted += 1
+
+        self.inflight[sequence_number] = McpInFlight(message, sequence_number, payload, now_ns, now_ns + self.backoff_ns(0))
+
+    def retransmitted(self, entry, now_ns=None):
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+
+        entry.retries += 1
+        entry.sent_ns = now_ns
+        entry.deadline_ns = now_ns + self.backoff_ns(entry.retries)
+        self.inflight[entry.sequence_number] = entry
+
+    def acked(self, ack, sequence_number=None, now_ns=None):
+        # Returns (entry, send to ack latency in ns), (None, None) if nothing was waiting on this ack
+        message = MCP_ACKED_BY.get(ack)
+        entry = self.inflight.get(sequence_number) if sequence_number is not None else None
+
+        if entry is None or entry.message != message:
+            # The MCP doesn't always echo our sequence number, fall back to the oldest message of the kind it acks
+            entry = next((entry for entry in self.inflight.values() if entry.message == message), None)
+            if entry is None:
+                return None, None
+
+        del self.inflight[entry.sequence_number]
+
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        latency_ns = now_ns - entry.sent_ns
+
+        # Same as the ESP side, only first time acks count towards latency
+        if entry.retries == 0:
+            stats = self.latency.get(entry.message)
+            if stats is None:
+                stats = self.latency[entry.message] = LatencyStats()
+            stats.record(latency_ns)
+
+        return entry, latency_ns
+
+    def forget(self, message):
+        # Stops retransmitting every message of this kind, for when something else has taken over resending it
+        for stale in [entry.sequence_number for entry in self.inflight.values() if entry.message == message]:
+            del self.inflight[stale]
+
+    def expired(self, now_ns=None):
+        # Pops and returns every entry past its deadline, caller decides to retransmit or give up
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+
+        expired = [entry for entry in self.inflight.values() if entry.deadline_ns <= now_ns]
+        for entry in expired:
+            del self.inflight[entry.sequence_number]
+        return expired
+
+    def next_deadline_ns(self):
+        if not self.inflight:
+            return None
+        return min(entry.deadline_ns for entry in self.inflight.values())
+
+    def clear(self):
+        self.inflight.clear()
+
+    def latency_summary(self):
+        return {message: stats.summary() for message, stats in self.latency.items()}
+
+# MCP EXEC Dedup
+
+MCP_EXEC_DEDUP_WINDOW = 5.0 # Seconds an EXEC is remembered, comfortably longer than the MCP takes to give up retrying one
+MCP_EXEC_DEDUP_MAX = 64
+
+class McpExecDedup:
+    # Recently carried out EXECs by identity, oldest first, so a repeat gets the original reply instead of moving the BR again
+    def __init__(self, window=MCP_EXEC_DEDUP_WINDOW, max_size=MCP_EXEC_DEDUP_MAX):
+        self.window_ns = int(window * NS_PER_S)
+        self.max_size = max_size
+        self.seen = {} # identity -> (expiry ns, cached reply)
+        self.suppressed = 0
+
+    def __len__(self):
+        return len(self.seen)
+
+    def expire(self, now_ns):
+        # Every entry gets the same window, so the oldest are always the first to go
+        while self.seen:
+            oldest = next(iter(self.seen))
+            if self.seen[oldest][0] > now_ns:
+                break
+            del self.seen[oldest]
+
+    def lookup(self, identity, now_ns=None):
+        # Returns (True, cached reply) for a duplicate, (False, None) for anything new
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        self.expire(now_ns)
+
+        hit = self.seen.get(identity)
+        if hit is None:
+            return False, None
+
+        self.suppressed += 1
+        return True, hit[1]
+
+    def remember(self, identity, reply, now_ns=None):
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+
+        while len(self.seen) >= self.max_size:
+            del self.seen[next(iter(self.seen))]
+        self.seen[identity] = (now_ns + self.window_ns, reply)
+
+# STAT Publishing
+
+STAT_MIN_INTERVAL = 0.1 # Seconds between STATs, a burst of changes inside this goes out as one STAT with the latest status
+STAT_REFRESH_INTERVAL = 2.0 # An unchanged status is still re-sent this often so the MCP knows we're alive
+
+class StatusPublisher:
+    # Decides when a STAT is worth sending, the caller always sends the status as it is at that moment
+    def __init__(self, min_interval=STAT_MIN_INTERVAL, refresh_interval=STAT_REFRESH_INTERVAL):
+        self.min_interval_ns = int(min_interval * NS_PER_S)
+        self.refresh_interval_ns = int(refresh_interval * NS_PER_S)
+        self.last_status = None
+        self.last_sent_ns = None
+        self.held = False # A change is waiting out the minimum interval
+        self.coalesced = 0 # Changes folded into a later STAT rather than sent on their own
+
+    def due(self, status, now_ns=None):
+        # True if a STAT carrying status should go out now
+        if self.last_sent_ns is None:
+            return True
+
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        since_sent_ns = now_ns - self.last_sent_ns
+
+        if status != self.last_status:
+            if since_sent_ns >= self.min_interval_ns:
+                return True
+            if not self.held:
+                self.held = True
+                self.coalesced += 1
+            return False
+
+        return since_sent_ns >= self.refresh_interval_ns
+
+    def published(self, status, now_ns=None):
+        # Every STAT that goes out counts, requested (STRQ) or not
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        self.last_status = status
+        self.last_sent_ns = now_ns
+        self.held = False
+
+    def next_due_ns(self, status):
+        # When due() could next say yes for this status
+        if self.last_sent_ns is None:
+            return None
+        if status != self.last_status:
+            return self.last_sent_ns + self.min_interval_ns
+        return self.last_sent_ns + self.refresh_interval_ns
+
+    def reset(self):
+        # The MCP needs telling afresh (new CCIN), don't assume it has our last status
+        self.last_status = None
+        self.last_sent_ns = None
+        self.held = False
+
+# MCP Liveness
+
+MCP_SILENCE_TIMEOUT = 6.0 # Seconds without a valid message before the MCP counts as gone, three STAT refreshes it should have acked
+MCP_REINIT_BASE = 0.5 # Seconds before the first re-sent CCIN, doubled for each one after
+MCP_REINIT_CAP = 8.0
+
+class McpWatchdog:
+    # Tracks when we last heard from the MCP, and once it has gone quiet, when the next CCIN should go out
+    def __init__(self, silence_timeout=MCP_SILENCE_TIMEOUT, reinit_base=MCP_REINIT_BASE, reinit_cap=MCP_REINIT_CAP):
+        self.silence_ns = int(silence_timeout * NS_PER_S)
+        self.reinit_base_ns = int(reinit_base * NS_PER_S)
+        self.reinit_cap_ns = int(reinit_cap * NS_PER_S)
+        self.last_heard_ns = None # None until the first CCIN, there's nothing to miss before then
+        self.lost = False
+        self.reinit_due_ns = None
+        self.reinit_attempts = 0
+        self.outages = 0
+
+    def arm(self, now_ns=None):
+        # First CCIN is out, the MCP has one silence timeout to answer it
+        self.heard(now_ns)
+
+    def heard(self, now_ns=None):
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        self.last_heard_ns = now_ns
+
+    def silent(self, now_ns=None):
+        # True once, the moment the MCP has been quiet for the whole timeout
+        if self.lost or self.last_heard_ns is None:
+            return False
+
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        if now_ns - self.last_heard_ns < self.silence_ns:
+            return False
+
+        self.reinit_attempts = 0
+        self.reinit_due_ns = now_ns
+        self.outages += 1
+        self.lost = True
+        return True
+
+    def reinit_due(self, now_ns=None):
+        # True if a CCIN should go out now, each one pushes the next further out
+        if not self.lost:
+            return False
+
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        if now_ns < self.reinit_due_ns:
+            return False
+
+        self.reinit_due_ns = now_ns + min(self.reinit_base_ns << self.reinit_attempts, self.reinit_cap_ns)
+        self.reinit_attempts += 1
+        return True
+
+    def registered(self):
+        # AKIN is in, returns True if that ended an outage
+        if not self.lost:
+            return False
+        self.lost = False
+        self.reinit_due_ns = None
+        return True
+
+    def silence_deadline_ns(self):
+        # When silent() could next say yes, None while already lost or not yet armed
+        if self.lost or self.last_heard_ns is None:
+            return None
+        return self.last_heard_ns + self.silence_ns
+
+    def quiet_for(self, now_ns=None):
+        # Seconds since the MCP was last heard from
+        if self.last_heard_ns is None:
+            return None
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        return (now_ns - self.last_heard_ns) / NS_PER_S
+
+# Lock Timing
+
+class TimedLock:
+    # threading.Lock that keeps its own figures, how often it was taken, how often a thread had to wait for it and for how long,
+    # and how long it was held each time. Works anywhere a Lock does, threading.Condition included
+    # The figures are only written by whoever holds the lock, so they need no lock of their own
+    __slots__ = ("name", "lock", "acquired_ns", "acquisitions", "contended", "wait", "hold")
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquired_ns = 0
+        self.acquisitions = 0
+        self.contended = 0 # Acquisitions that found the lock taken and had to wait
+        self.wait = LatencyStats()
+        self.hold = LatencyStats()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self.lock.acquire(False):
+            if not blocking:
+                return False
+            wait_from_ns = time.perf_counter_ns()
+            if not self.lock.acquire(True, timeout):
+                return False
+            self.contended += 1
+            self.wait.record(time.perf_counter_ns() - wait_from_ns)
+        self.acquisitions += 1
+        self.acquired_ns = time.perf_counter_ns()
+        return True
+
+    __enter__ = acquire
+
+    def release(self):
+        self.hold.record(time.perf_counter_ns() - self.acquired_ns)
+        self.lock.release()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def summary(self):
+        return {"acquisitions": self.acquisitions, "contended": self.contended, "wait": self.wait.summary(), "hold": self.hold.summary()}
@@ -0,0 +1,179 @@
+import json, time
+import pytest
+from ccp_protocol import ESP_ACK, bladeRunnerCommands, create_mcp_msg
+from ccp_core import CcpCore
+from ccp_capture import CAPTURE_ESP_ATTACH, CAPTURE_MCP_OUT
+from ccp_replay import ReplayCCP
+
+# Shared BR handling driven straight through CcpCore, with an engine that just records what it would have sent
+# Run with: python -m pytest -q (from py_serv/)
+
+class RecordingCCP(CcpCore):
+    def __init__(self):
+        super().__init__("BR28", "test")
+        self.esp_attached = True
+        self.esp_out = []
+        self.mcp_out = []
+
+    def esp_write(self, byte_data):
+        if not self.esp_attached:
+            return False
+        self.esp_out.append(bytes(byte_data))
+        return True
+
+    def mcp_write(self, message, payload):
+        self.mcp_out.append(message)
+
+class FakeClock:
+    def __init__(self):
+        self.now_ns = time.monotonic_ns()
+
+    def __call__(self):
+        return self.now_ns
+
+    def advance(self, seconds):
+        self.now_ns += int(seconds * 1_000_000_000)
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(time, "monotonic_ns", clock)
+    return clock
+
+@pytest.fixture
+def ccp(clock):
+    ccp = RecordingCCP()
+    ccp.esp_link_attached()
+    return ccp
+
+def mcp_exec(action, sequence_number):
+    mcp_msg = create_mcp_msg("BR28", "EXEC", sequence_number)
+    mcp_msg["action"] = action
+    return mcp_msg
+
+def esp_ack(cmd):
+    return ESP_ACK << 8 | cmd
+
+def test_stop_drops_unacked_drive(ccp, clock):
+    # FSLOWC goes unACKed, STOPC is ACKed, and the ESP must never see the forward command again
+    ccp.parse_mcp_response(mcp_exec("FSLOWC", 1001))
+    clock.advance(0.1)
+    ccp.parse_mcp_response(mcp_exec("STOPC", 1002))
+    clock.advance(0.01)
+    ccp.parse_esp_response(esp_ack(bladeRunnerCommands["STOP"]))
+
+    for _ in range(10):
+        clock.advance(0.5)
+        ccp.check_esp_acks()
+
+    assert ccp.esp_out == [bytes((bladeRunnerCommands["FORWARD-SLOW"],)), bytes((bladeRunnerCommands["STOP"],))]
+    assert len(ccp.esp_pending) == 0
+
+def test_unacked_latest_drive_is_resent(ccp, clock):
+    ccp.parse_mcp_response(mcp_exec("FSLOWC", 1001))
+    clock.advance(0.1)
+    ccp.parse_mcp_response(mcp_exec("FFASTC", 1002))
+    clock.advance(0.5)
+    ccp.check_esp_acks()
+
+    forward_fast = bytes((bladeRunnerCommands["FORWARD-FAST"],))
+    assert ccp.esp_out == [bytes((bladeRunnerCommands["FORWARD-SLOW"],)), forward_fast, forward_fast]
+
+def open_door(ccp):
+    ccp.parse_esp_response(esp_ack(bladeRunnerCommands["STOP"]))
+    ccp.parse_esp_response(esp_ack(bladeRunnerCommands["DOORS-OPEN"]))
+    assert ccp.br.snapshot.door_open
+
+def run_acks(ccp, clock, seconds):
+    for _ in range(int(seconds / 0.05)):
+        clock.advance(0.05)
+        ccp.check_esp_acks()
+
+def test_drive_waits_for_door_close(ccp, clock):
+    # With the door open a drive goes out as 06 01, and the ESP doesn't get to the drive til the door has shut
+    open_door(ccp)
+    ccp.parse_mcp_response(mcp_exec("FSLOWC", 1001))
+    run_acks(ccp, clock, 2.0)
+    ccp.parse_esp_response(esp_ack(bladeRunnerCommands["DOORS-CLOSE"]))
+    run_acks(ccp, clock, 0.1)
+    ccp.parse_esp_response(esp_ack(bladeRunnerCommands["FORWARD-SLOW"]))
+    run_acks(ccp, clock, 10.0)
+
+    assert ccp.esp_out == [bytes((bladeRunnerCommands["DOORS-CLOSE"], bladeRunnerCommands["FORWARD-SLOW"]))]
+    assert ccp.br.snapshot.status == "FSLOWC"
+
+def test_drive_after_door_close_ack_gets_its_own_deadline(ccp, clock):
+    # Once the door's ACK is in the drive is on its own 0.5 s again, an ESP that then goes quiet is still caught
+    open_door(ccp)
+    ccp.parse_mcp_response(mcp_exec("FSLOWC", 1001))
+    run_acks(ccp, clock, 1.0)
+    ccp.parse_esp_response(esp_ack(bladeRunnerCommands["DOORS-CLOSE"]))
+    run_acks(ccp, clock, 0.6)
+
+    assert ccp.esp_out[1:] == [bytes((bladeRunnerCommands["FORWARD-SLOW"],))]
+
+def test_stop_waits_for_door_move(ccp, clock):
+    # A STOP sent while the door is still closing sits behind it on the ESP, it isn't resent while the door finishes
+    open_door(ccp)
+    ccp.parse_mcp_response(mcp_exec("FSLOWC", 1001))
+    run_acks(ccp, clock, 1.0)
+    ccp.parse_mcp_response(mcp_exec("STOPC", 1002))
+    run_acks(ccp, clock, 2.0)
+    ccp.parse_esp_response(esp_ack(bladeRunnerCommands["DOORS-CLOSE"]))
+    ccp.parse_esp_response(esp_ack(bladeRunnerCommands["STOP"]))
+    ccp.parse_esp_response(esp_ack(bladeRunnerCommands["DOORS-CLOSE"]))
+    run_acks(ccp, clock, 10.0)
+
+    # The door still counted as open when the STOP was planned, so it's followed by another close
+    assert ccp.esp_out[1:] == [bytes((bladeRunnerCommands["STOP"], bladeRunnerCommands["DOORS-CLOSE"]))]
+    assert ccp.br.snapshot.status == "STOPC"
+
+def test_exec_while_detached_is_refused(ccp, clock):
+    # Nothing is held during an outage, the MCP gets a NOIP instead of an AKEX and the BR is stopped when it's back
+    ccp.esp_attached = False
+    ccp.esp_link_detached()
+    ccp.mcp_out.clear()
+    for sequence_number, action in enumerate(("FFASTC", "STOPC", "FSLOWC", "RSLOWC"), 1001):
+        ccp.parse_mcp_response(mcp_exec(action, sequence_number))
+    assert ccp.mcp_out.count("NOIP") == 4
+    assert "AKEX" not in ccp.mcp_out
+    assert ccp.esp_out == []
+
+    ccp.esp_attached = True
+    ccp.esp_link_attached()
+    assert ccp.esp_out == [bytes((bladeRunnerCommands["STOP"],))]
+
+    # Never carried out, so a repeat of the same EXEC isn't a duplicate
+    ccp.parse_mcp_response(mcp_exec("RSLOWC", 1004))
+    assert ccp.esp_out[-1] == bytes((bladeRunnerCommands["REVERSE-SLOW"],))
+    assert ccp.mcp_out[-1] == "AKEX"
+
+def test_reregistration_is_paced_by_watchdog(clock):
+    # Once the MCP is lost only the watchdog's 0.5 s doubling backoff sends CCINs, none of them are retried on top
+    # Driven through the host engine's own core pass, the same way ccp_replay.py runs it
+    ccp = ReplayCCP({"br": "BR28"})
+    ccp.feed(CAPTURE_ESP_ATTACH, b"")
+
+    def ccins_sent():
+        return sum(1 for _, kind, data in ccp.capture.outputs if kind == CAPTURE_MCP_OUT and json.loads(data)["message"] == "CCIN")
+
+    while not ccp.mcp_watchdog.lost:
+        ccins_before = ccins_sent()
+        clock.advance(0.05)
+        ccp.tick()
+    for _ in range(160): # 8 s in 50 ms steps, CCINs due at 0, 0.5, 1.5, 3.5 and 7.5 s
+        clock.advance(0.05)
+        ccp.tick()
+
+    assert ccp.mcp_watchdog.lost
+    assert ccins_sent() - ccins_before == 5
+    assert all(entry.message != "CCIN" for entry in ccp.mcp_inflight.inflight.values())
+
+def test_non_integer_sequence_number_is_rejected(ccp):
+    # An unhashable sequence number would otherwise blow up the in flight lookup for this AKST
+    datagram = json.dumps({"client_type": "CCP", "message": "AKST", "client_id": "BR28", "sequence_number": [1]}).encode()
+    assert ccp.mcp_accept(datagram) is None
+    for sequence_number in ("1001", True, 1.5):
+        datagram = json.dumps({"client_type": "CCP", "message": "AKST", "client_id": "BR28", "sequence_number": sequence_number}).encode()
+        assert ccp.mcp_accept(datagram) is None
+    assert ccp.mcp_accept(json.dumps(create_mcp_msg("BR28", "AKST", 1001)).encode()) is not None
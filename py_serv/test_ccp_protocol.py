@@ -0,0 +1,115 @@
+import random
+import pytest
+from ccp_protocol import (bladeRunnerCommands, BR_STATUS, BR_STATES, BR_STATE_FLAGS, BR_EVENTS, BR_EVENT_ACK, BR_EVENT_ALERT,
+                          BR_EVENT_ACK_TIMEOUT, BR_EVENT_ESP_LOST, BR_TRANSITIONS, BrState, EspFrameDecoder, ESP_ACK, ESP_ALERT, ESP_PING, esp_ack_transition, esp_alert_transition,
+                          McpMsgTemplates, McpMsgFilter, create_mcp_msg, encode_mcp_msg)
+
+# Wire formats and lookup tables from ccp_protocol checked against the plain code they stand in for
+# Run with: python -m pytest -q (from py_serv/)
+
+SEQUENCE_NUMBERS = (0, 1000, 12345, 30000, 2 ** 31)
+
+@pytest.mark.parametrize("client_id", ("BR28", "BR95"))
+def test_templates_match_plain_encoding(client_id):
+    templates = McpMsgTemplates(client_id)
+    for sequence_number in SEQUENCE_NUMBERS:
+        for status in BR_STATUS:
+            assert templates.encode("STAT", sequence_number, status) == encode_mcp_msg(create_mcp_msg(client_id, "STAT", sequence_number, status))
+        for message in ("CCIN", "AKEX", "NOIP"):
+            assert templates.encode(message, sequence_number) == encode_mcp_msg(create_mcp_msg(client_id, message, sequence_number))
+
+def test_template_built_on_first_use():
+    # A message shape nobody pre-built still comes out the same as the plain encoding
+    templates = McpMsgTemplates("BR28")
+    assert templates.encode("STRQ", 4321) == encode_mcp_msg(create_mcp_msg("BR28", "STRQ", 4321))
+
+def expected_transition(status, door_open, last_cmd, event):
+    # What the plain ACK and ALERT rules say, as (status, door_open, last_cmd, level, message)
+    for cmd, ack_event in BR_EVENT_ACK.items():
+        if event == ack_event:
+            next_status, next_door_open, level, message = esp_ack_transition(cmd, door_open, last_cmd)
+            return next_status, next_door_open, cmd, level, message
+    for alert, alert_event in BR_EVENT_ALERT.items():
+        if event == alert_event:
+            alert_status, level, message = esp_alert_transition(alert)
+            return status if alert_status is None else alert_status, door_open, last_cmd, level, message
+    assert event in (BR_EVENT_ACK_TIMEOUT, BR_EVENT_ESP_LOST)
+    return "ERR", door_open, last_cmd, None, None
+
+def test_transition_table_matches_rules():
+    for state in range(BR_STATES):
+        status = BR_STATUS[state // BR_STATE_FLAGS]
+        door_open = bool(state & 2)
+        last_cmd = bladeRunnerCommands["STOP"] if state & 1 else None
+        for event in range(BR_EVENTS):
+            transition = BR_TRANSITIONS[state * BR_EVENTS + event]
+            next_status, next_door_open, next_last_cmd, level, message = expected_transition(status, door_open, last_cmd, event)
+
+            assert (transition.status, transition.door_open, transition.level, transition.message) == (next_status, next_door_open, level, message)
+            assert transition.state == BR_STATUS.index(next_status) * BR_STATE_FLAGS + next_door_open * 2 + (next_last_cmd == bladeRunnerCommands["STOP"])
+            assert transition.invalid == (event in BR_EVENT_ACK.values() and next_status == "ERR")
+
+def test_br_state_follows_rules_over_random_events():
+    rng = random.Random(2024)
+    br = BrState()
+    status, door_open, last_cmd = "STOPC", False, bladeRunnerCommands["STOP"]
+    for _ in range(100_000):
+        event = rng.randrange(BR_EVENTS)
+        status, door_open, last_cmd, level, message = expected_transition(status, door_open, last_cmd, event)
+        transition = br.apply(event, now_ns=0)
+
+        assert (transition.status, transition.level, transition.message) == (status, level, message)
+        assert (br.snapshot.status, br.snapshot.door_open) == (status, door_open)
+
+ESP_STREAM = bytes((ESP_ACK, 0x06, ESP_ACK, 0x01, ESP_ALERT, 0xAA, ESP_ACK, ESP_PING, ESP_ALERT, 0xBA))
+ESP_STREAM_FRAMES = [ESP_ACK << 8 | 0x06, ESP_ACK << 8 | 0x01, ESP_ALERT << 8 | 0xAA, ESP_ACK << 8 | ESP_PING, ESP_ALERT << 8 | 0xBA]
+
+def test_decoder_merged_frames():
+    assert EspFrameDecoder().feed(ESP_STREAM) == ESP_STREAM_FRAMES
+
+def test_decoder_split_frames():
+    # However TCP cuts the stream up, the same frames come out in the same order
+    for split in range(1, len(ESP_STREAM)):
+        decoder = EspFrameDecoder()
+        assert decoder.feed(ESP_STREAM[:split]) + decoder.feed(ESP_STREAM[split:]) == ESP_STREAM_FRAMES
+
+    rng = random.Random(4)
+    for _ in range(200):
+        decoder = EspFrameDecoder()
+        frames, offset = [], 0
+        while offset < len(ESP_STREAM):
+            chunk = rng.randint(1, 5)
+            frames += decoder.feed(ESP_STREAM[offset:offset + chunk])
+            offset += chunk
+        assert frames == ESP_STREAM_FRAMES
+
+def test_decoder_reset_drops_half_frame():
+    decoder = EspFrameDecoder()
+    assert decoder.feed(ESP_STREAM[:3]) == ESP_STREAM_FRAMES[:1]
+    decoder.reset()
+    assert decoder.feed(ESP_STREAM[4:6]) == ESP_STREAM_FRAMES[2:3]
+
+def test_filter_tells_br2_from_br28():
+    br28_msg = encode_mcp_msg(create_mcp_msg("BR28", "STRQ", 1001))
+    br2_msg = encode_mcp_msg(create_mcp_msg("BR2", "STRQ", 1001))
+    assert McpMsgFilter("BR2").decode(br28_msg) == (None, None)
+    assert McpMsgFilter("BR28").decode(br2_msg) == (None, None)
+    assert McpMsgFilter("BR2").decode(br2_msg)[0]["client_id"] == "BR2"
+    assert McpMsgFilter("BR28").decode(br28_msg)[0]["client_id"] == "BR28"
+
+def test_filter_accepts_spacing_the_mcp_may_use():
+    mcp_msg, reject_reason = McpMsgFilter("BR28").decode(b'{"client_type":"CCP","message":"STRQ","client_id":"BR28","sequence_number":5}')
+    assert reject_reason is None and mcp_msg["message"] == "STRQ"
+
+@pytest.mark.parametrize("data", (
+    b'{"client_type": "CCP", "message": "STRQ", "client_id": "BR95", "note": "BR28"}', # Our id, but not as the client_id
+    b'{"client_type": "MCP", "message": "STRQ", "client_id": "BR28"}',
+    b'{"client_type": "CCP", "message": "STRQ", "client_id": "BR28"',
+    b'{"client_type": "CCP", "message": "STRQ", "client_id": "BR28", "x": "\xff"}', # Not UTF-8
+    b'[{"client_type": "CCP", "message": "STRQ", "client_id": "BR28"}]',
+    b'{"client_type": "CCP", "message": 7, "client_id": "BR28"}',
+    b'{"client_type": "CCP", "client_id": "BR28"}',
+))
+def test_filter_rejects_malformed(data):
+    mcp_msg, reject_reason = McpMsgFilter("BR28").decode(data)
+    assert mcp_msg is None and reject_reason is not None
@@ -92,6 +92,7 @@ Servo rightdoor;
 // Custom Byte Codes
 // 0x07 - SetSlowSpeed ex. 0x07 0xFF -> Slow Speed set to 255
 // 0x08 - SetFastSpeed ex 0x08 0xFF -> Fast Speed set to 255
+// 0xEC - Ping, ACKed straight back so the CCP can check the link and time the round trip
 
 // Custom Byte Code Variables //
 int newSpeed;
@@ -749,6 +750,9 @@ void decipherCCPCommand(){
         newSpeed = client.read();
         setFastSpeed(newSpeed);
         break;
+      case 0xEC:
+        sendAckToCCP(data);
+        break;
       case 0xEE:
         playAudio();
         break;